@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark analysis, jukebox creation, and server start-up
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib import analysis, config, cue, features, generation, jukebox, metadata_db, musly, tags, version
+
+
+def info(s):
+    print("INFO: %s" % s)
+
+
+def error(s):
+    print("ERROR: %s" % s)
+    exit(-1)
+
+
+def reset_peak_rss():
+    ''' Reset the peak RSS of this process, so that the peak of each stage can be read (Linux only) '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except:
+        pass
+
+
+def get_peak_rss():
+    ''' Peak RSS, in MB, of this process and of the largest child process (analysis uses a process per file) '''
+    peak = 0
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    peak = int(line.split()[1])
+    except:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (round(peak/1024.0, 1), round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.0, 1))
+
+
+class Stages(object):
+    def __init__(self):
+        self.results = {}
+
+
+    def run(self, name, num_tracks, func, *args):
+        reset_peak_rss()
+        start = time.monotonic()
+        result = func(*args)
+        secs = time.monotonic()-start
+        (rss, child_rss) = get_peak_rss()
+        self.results[name] = {'seconds':round(secs, 4), 'peak_rss_mb':rss, 'child_peak_rss_mb':child_rss}
+        if num_tracks is not None:
+            self.set_tracks(name, num_tracks)
+        return result
+
+
+    def set_tracks(self, name, num_tracks):
+        stage = self.results[name]
+        stage['tracks'] = num_tracks
+        stage['tracks_per_sec'] = round(num_tracks/stage['seconds'], 2) if stage['seconds']>0 else None
+        info('%-10s %8.3fs  %8s tracks/sec  %7.1fMB' % (name, stage['seconds'], stage['tracks_per_sec'], stage['peak_rss_mb']))
+
+
+def read_all_tags(files):
+    return [tags.read_tags(file['abs'], metadata_db.GENRE_SEPARATOR) for file in files]
+
+
+def save_metadata(meta_db, files, all_tags):
+    ''' Only the DB writes, tags have already been read '''
+    for file, meta in zip(files, all_tags):
+        if meta is not None:
+            meta_db.set_metadata(file, meta)
+    meta_db.commit()
+
+
+def load_jukebox(mus, cfg, meta_db, jukebox_path):
+    (paths, mtracks) = features.load_tracks(mus, cfg, meta_db)
+    return jukebox.update_jukebox(mus, cfg, meta_db, jukebox_path, paths, mtracks, None, True)
+
+
+def get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.strip()
+    except:
+        return None
+
+
+def run_benchmark(cfg, num_threads):
+    mus = musly.Musly(cfg['libmusly'])
+    meta_db = metadata_db.MetadataDb(cfg)
+    lms_db = sqlite3.connect(cfg['lmsdb']) if 'lmsdb' in cfg else None
+    jukebox_path = os.path.join(cfg['paths']['db'], 'musly.jukebox')
+    musly_root_len = len(cfg['paths']['musly'])
+    stages = Stages()
+    files = []
+    with tempfile.TemporaryDirectory(dir=cfg['paths']['tmp'] if 'tmp' in cfg['paths'] else None) as tmp_path:
+        stages.run('discovery', None, analysis.get_files_to_analyse, meta_db, lms_db, cfg['paths']['lms'], cfg['paths']['musly'], files, musly_root_len, tmp_path+'/', len(tmp_path)+1, False)
+        num_tracks = len(files)
+        stages.set_tracks('discovery', num_tracks)
+        if num_tracks==0:
+            error('No tracks found')
+        num_cue = len([f for f in files if 'track' in f])
+        if num_cue>0:
+            stages.run('cuesplit', num_cue, cue.split_cue_tracks, files, num_threads)
+        stages.run('analysis', num_tracks, mus.analyze_files, meta_db, files, cfg['extractlen'], cfg['extractstart'], num_threads)
+        all_tags = stages.run('tags', num_tracks, read_all_tags, files)
+        stages.run('metadata', num_tracks, save_metadata, meta_db, files, all_tags)
+    stages.run('rowids', num_tracks, meta_db.force_rowid_update)
+    if stages.run('jukebox', num_tracks, load_jukebox, mus, cfg, meta_db, jukebox_path) is None:
+        error('Failed to create jukebox')
+    meta_db.close()
+    if lms_db is not None:
+        lms_db.close()
+
+    # Server start-up, from the files written above
+    gen = stages.run('startup', num_tracks, generation.Generation, 1, musly.Musly(cfg['libmusly'], True), cfg, jukebox_path, os.path.join(cfg['paths']['db'], 'musly.neighbours'))
+    gen.close()
+    return stages.results
+
+
+def compare(results, previous):
+    info('Change vs %s (%s)' % (previous['time'], previous['revision']))
+    for name in results['stages']:
+        if name in previous['stages'] and previous['stages'][name]['seconds']>0:
+            change = (results['stages'][name]['seconds']-previous['stages'][name]['seconds'])*100.0/previous['stages'][name]['seconds']
+            info('%-10s %+7.1f%%' % (name, change))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Musly API Server analysis (v%s)' % version.MUSLY_SERVER_VERSION)
+    parser.add_argument('-c', '--config', type=str, help='Config file, as written by mklibrary.py', required=True)
+    parser.add_argument('-o', '--output', type=str, help='File to write results to (default: %(default)s)', default='results.json')
+    parser.add_argument('-p', '--previous', type=str, help='Results of a previous run to compare against', default=None)
+    parser.add_argument('-t', '--threads', type=int, help='Number of analysis threads (default: threads from config)', default=0)
+    parser.add_argument('-l', '--log-level', action='store', choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'], default='WARNING', help='Set log level (default: %(default)s)')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=args.log_level, datefmt='%Y-%m-%d %H:%M:%S')
+
+    cfg = config.read_config(args.config, True)
+    if not 'benchmark' in cfg:
+        error('%s was not written by mklibrary.py' % args.config)
+    num_threads = args.threads if args.threads>0 else cfg['threads']
+    # Always start from an empty DB
+    db_path = cfg['paths']['db']
+    shutil.rmtree(db_path)
+    os.makedirs(db_path)
+
+    results = {'version':version.MUSLY_SERVER_VERSION, 'revision':get_revision(), 'time':datetime.now().isoformat(timespec='seconds'),
+               'host':platform.node(), 'machine':platform.machine(), 'python':platform.python_version(), 'cpus':os.cpu_count(),
+               'threads':num_threads, 'libmusly':cfg['libmusly']}
+    start = time.monotonic()
+    results['stages'] = run_benchmark(cfg, num_threads)
+    results['seconds'] = round(time.monotonic()-start, 4)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    info('Wrote %s' % args.output)
+
+    if args.previous is not None:
+        with open(args.previous, 'r') as f:
+            compare(results, json.load(f))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+#
+# Create a synthetic music library, for benchmarking analysis
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+SAMPLE_RATE = 22050
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 3
+GENRES = ['Rock', 'Pop', 'Jazz', 'Classical', 'Electronic', 'Folk', 'Metal', 'Ambient']
+NOISE_COLOURS = ['white', 'pink', 'brown', 'blue', 'violet', 'velvet']
+
+
+def info(s):
+    print("INFO: %s" % s)
+
+
+def error(s):
+    print("ERROR: %s" % s)
+    exit(-1)
+
+
+def get_source(rnd, duration):
+    ''' ffmpeg lavfi source - a random mix of tones, noise, and sweeps, so that tracks have different timbres '''
+    kind = rnd.randint(0, 3)
+    if kind==0:
+        return 'sine=frequency=%d:sample_rate=%d:duration=%d' % (rnd.randint(80, 4000), SAMPLE_RATE, duration)
+    if kind==1:
+        return 'anoisesrc=color=%s:amplitude=%.2f:sample_rate=%d:duration=%d' % (rnd.choice(NOISE_COLOURS), rnd.uniform(0.1, 0.9), SAMPLE_RATE, duration)
+    if kind==2:
+        # Tone with tremolo, and a harmonic
+        freq = rnd.randint(80, 2000)
+        expr = '0.5*sin(%d*2*PI*t)*(0.6+0.4*sin(%.2f*2*PI*t))+0.2*sin(%d*2*PI*t)' % (freq, rnd.uniform(0.5, 8.0), freq*rnd.randint(2, 5))
+        return 'aevalsrc=%s:s=%d:d=%d' % (expr, SAMPLE_RATE, duration)
+    # Sweep
+    expr = '0.5*sin(2*PI*(%d+%d*t)*t)' % (rnd.randint(50, 500), rnd.randint(10, 200))
+    return 'aevalsrc=%s:s=%d:d=%d' % (expr, SAMPLE_RATE, duration)
+
+
+def create_file(path, source, tags):
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', source, '-ac', '2', '-b:a', '64k']
+    for key in tags:
+        command += ['-metadata', '%s=%s' % (key, tags[key])]
+    command.append(path)
+    return subprocess.run(command, stdin=subprocess.DEVNULL).returncode==0
+
+
+def write_cue(path, audio_file, album, artist, titles, duration):
+    with open(path, 'w') as f:
+        f.write('PERFORMER "%s"\nTITLE "%s"\nFILE "%s" MP3\n' % (artist, album, audio_file))
+        for i, title in enumerate(titles):
+            start = i*duration
+            f.write('  TRACK %02d AUDIO\n    TITLE "%s"\n    INDEX 01 %02d:%02d:00\n' % (i+1, title, start//60, start%60))
+
+
+def create_library(dest, num_tracks, duration, cue_albums, threads, seed):
+    rnd = random.Random(seed)
+    music = os.path.join(dest, 'music')
+    jobs = []
+    cue_tracks = [] # (LMS url, title) of each CUE track, for LMS DB
+    track = 0
+    album_num = 0
+    while track<num_tracks:
+        artist = 'Artist %d' % (album_num//ALBUMS_PER_ARTIST + 1)
+        album = 'Album %d' % (album_num + 1)
+        genre = rnd.choice(GENRES)
+        folder = os.path.join(music, artist, album)
+        os.makedirs(folder, exist_ok=True)
+        count = min(TRACKS_PER_ALBUM, num_tracks-track)
+        titles = ['Title %d' % (t+1) for t in range(count)]
+        if album_num<cue_albums:
+            # Whole album as one file, split via CUE sheet
+            name = '%s.mp3' % album
+            path = os.path.join(folder, name)
+            jobs.append((path, get_source(rnd, duration*count), {'title':album, 'artist':artist, 'album':album, 'album_artist':artist, 'genre':genre}))
+            write_cue(os.path.join(folder, '%s.cue' % album), name, album, artist, titles, duration)
+            for t in range(count):
+                cue_tracks.append(('file://%s#%d-%d' % (quote(path), t*duration, (t+1)*duration), titles[t]))
+        else:
+            for t in range(count):
+                path = os.path.join(folder, '%02d %s.mp3' % (t+1, titles[t]))
+                jobs.append((path, get_source(rnd, duration), {'title':titles[t], 'artist':artist, 'album':album, 'album_artist':artist, 'genre':genre, 'track':t+1}))
+        track += count
+        album_num += 1
+
+    info('Creating %d files, for %d tracks' % (len(jobs), num_tracks))
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(lambda job: create_file(*job), jobs))
+    if not all(results):
+        error('Failed to create %d files' % results.count(False))
+
+    # CUE tracks are listed by reading LMS's DB, so create a minimal version of this
+    lms_db = os.path.join(dest, 'lms.db')
+    if os.path.exists(lms_db):
+        os.remove(lms_db)
+    conn = sqlite3.connect(lms_db)
+    conn.execute('CREATE TABLE tracks (url varchar, title varchar)')
+    conn.executemany('INSERT INTO tracks (url, title) VALUES (?, ?)', cue_tracks)
+    conn.commit()
+    conn.close()
+    return (music, lms_db)
+
+
+def write_config(dest, music, lms_db, threads):
+    db = os.path.join(dest, 'db')
+    tmp = os.path.join(dest, 'tmp')
+    os.makedirs(db, exist_ok=True)
+    os.makedirs(tmp, exist_ok=True)
+    config = {'libmusly':os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib', 'x86-64', 'fedora', 'libmusly.so'),
+              'paths':{'musly':music, 'lms':music, 'db':db, 'tmp':tmp}, 'lmsdb':lms_db, 'threads':threads, 'genres':[GENRES[:3], GENRES[3:6]],
+              'benchmark':True} # bench.py only deletes DB folder if this is set
+    path = os.path.join(dest, 'config.json')
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=1)
+    return path
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Create synthetic music library, using ffmpeg, for benchmarking')
+    parser.add_argument('-d', '--dest', type=str, help='Folder to create library in', required=True)
+    parser.add_argument('-n', '--tracks', type=int, help='Number of tracks (default: %(default)s)', default=1000)
+    parser.add_argument('-l', '--length', type=int, help='Length of each track, in seconds (default: %(default)s)', default=40)
+    parser.add_argument('-c', '--cue', type=int, help='Number of albums to create as a single file with a CUE sheet (default: %(default)s)', default=0)
+    parser.add_argument('-t', '--threads', type=int, help='Number of concurrent ffmpeg processes (default: CPU count)', default=os.cpu_count())
+    parser.add_argument('-s', '--seed', type=int, help='Random seed, the same seed creates the same library (default: %(default)s)', default=1)
+    args = parser.parse_args()
+
+    try:
+        subprocess.run(['ffmpeg', '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        error('ffmpeg is required')
+    if os.path.exists(os.path.join(args.dest, 'music')):
+        error('%s already contains a library' % args.dest)
+
+    (music, lms_db) = create_library(args.dest, args.tracks, args.length, args.cue, args.threads, args.seed)
+    info('Wrote %s' % write_config(args.dest, music, lms_db, args.threads))
@@ -10,7 +10,8 @@ import os
 import random
 import sqlite3
 import tempfile
-from . import cue, metadata_db, musly
+import uuid
+from . import clusters, cue, features, jukebox, metadata_db, musly, neighbours
 
 _LOGGER = logging.getLogger(__name__)
 AUDIO_EXTENSIONS = ['m4a', 'mp3', 'ogg', 'flac', 'opus']
@@ -33,9 +34,12 @@ def get_files_to_analyse(meta_db, lms_db, lms_path, path, files, musly_root_len,
             files.append({'abs':path, 'db':path[musly_root_len:]})
 
 
-def analyse_files(mus, config, path, remove_tracks, meta_only, jukebox):
+def analyse_files(mus, config, path, remove_tracks, meta_only, restyle, jukebox_path, neighbours_file):
     _LOGGER.debug('Analyse %s' % path)
     meta_db = metadata_db.MetadataDb(config)
+    meta_db.update_normalized()
+    meta_db.update_vals_format()
+    old_paths = meta_db.get_paths()
     lms_db = sqlite3.connect(config['lmsdb']) if 'lmsdb' in config else None
         
     files = []
@@ -58,10 +62,27 @@ def analyse_files(mus, config, path, remove_tracks, meta_only, jukebox):
                 for file in files:
                     meta_db.set_metadata(file)
             meta_db.commit()
-            if removed_tracks or (added_tracks and not meta_only):
-                (paths, db_tracks) = mus.get_alltracks_db(meta_db.get_cursor())
-                mus.add_tracks(db_tracks, config['styletracks'], config['styletracksmethod'], meta_db)
-            meta_db.close()
-            if removed_tracks or not meta_only:
-                mus.write_jukebox(jukebox)
+        if removed_tracks or (added_tracks and not meta_only):
+            # Features have changed, so feature file needs to be re-written
+            meta_db.set_setting('featuresid', uuid.uuid4().hex)
+        if removed_tracks or (added_tracks and not meta_only) or restyle:
+            update_jukebox(mus, config, meta_db, old_paths, restyle, jukebox_path, neighbours_file)
+        if not meta_only and config['clusters']>0:
+            (paths, db_tracks) = features.load_tracks(mus, config, meta_db)
+            clusters.update_index(mus, config, meta_db, paths, db_tracks)
+        meta_db.close()
     _LOGGER.debug('Finished analysis')
+
+
+def update_jukebox(mus, config, meta_db, old_paths, restyle, jukebox_path, neighbours_file):
+    (paths, db_tracks) = features.load_tracks(mus, config, meta_db)
+    ids = jukebox.update_jukebox(mus, config, meta_db, jukebox_path, paths, db_tracks, old_paths, restyle)
+    if ids is not None:
+        neighbours.update_neighbours(mus, meta_db, paths, db_tracks, ids, neighbours_file, config['threads'])
+
+
+def restyle_jukebox(mus, config, jukebox_path, neighbours_file):
+    ''' Re-create jukebox, choosing new style tracks '''
+    meta_db = metadata_db.MetadataDb(config)
+    update_jukebox(mus, config, meta_db, None, True, jukebox_path, neighbours_file)
+    meta_db.close()
@@ -9,13 +9,16 @@ import argparse
 from datetime import datetime
 import json
 import logging
-import math
+import hmac
+import numpy
 import os
 import random
+import signal
 import sqlite3
-import urllib
-from flask import Flask, abort, request
-from . import cue, filters, metadata_db, musly
+import threading
+import time
+from flask import Flask, Response, abort, g, request
+from . import cue, filters, generation, metrics, mixcache, musly, prefork, trace
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -26,42 +29,105 @@ DEFAULT_NUM_PREV_TRACKS_FILTER_ARTIST = 15 # Try to ensure artist is not in prev
 DEFAULT_NUM_PREV_TRACKS_FILTER_ALBUM  = 25 # Try to ensure album is not in previous N tracks
 NUM_SIMILAR_TRACKS_FACTOR             = 25 # Request count*NUM_SIMILAR_TRACKS_FACTOR from musly
 SHUFFLE_FACTOR                        = 3  # How many (shuffle_factor*count) tracks to shuffle?
+DUMP_CHUNK_SIZE                       = 1000 # Min number of tracks to read at a time in dump API
+DUMP_STREAM_TRACKS                    = 100  # Number of tracks written at a time by dump API
 
 
 class MuslyApp(Flask):
-    def init(self, args, mus, app_config, jukebox_path):
+    def init(self, args, mus, app_config, jukebox_path, neighbours_path):
         _LOGGER.debug('Start server')
         self.app_config = app_config
         self.mus = mus
+        self.jukebox_path = jukebox_path
+        self.neighbours_path = neighbours_path
+        self.lock = threading.Lock()
+        self.reloading = False
+        self.master_pid = None # Set in worker processes, when pre-forked
         
         flask_logging = logging.getLogger('werkzeug')
         flask_logging.setLevel(args.log_level)
         flask_logging.disabled = 'DEBUG'!=args.log_level
-        meta_db = metadata_db.MetadataDb(app_config)
-        (paths, tracks) = self.mus.get_alltracks_db(meta_db.get_cursor())
         random.seed()
-        ids = None
-
-        # If we can, load musly from jukebox...
-        if os.path.exists(jukebox_path):
-            ids = self.mus.get_jukebox_from_file(jukebox_path)
-
-        if ids==None or len(ids)!=len(tracks):
-            _LOGGER.debug('Adding tracks from DB to musly')
-            ids = mus.add_tracks(tracks, app_config['styletracks'], app_config['styletracksmethod'], meta_db)
-            self.mus.write_jukebox(jukebox_path)
-
-        meta_db.close()
-        self.mta=musly.MuslyTracksAdded(paths, tracks, ids)
+        self.generation = generation.Generation(1, mus, app_config, jukebox_path, neighbours_path)
+        self.before_request(self.acquire_generation)
+        self.after_request(self.record_request)
+        self.teardown_request(self.release_generation)
+
+    def acquire_generation(self):
+        ''' Lease the current generation for the duration of a request '''
+        with self.lock:
+            gen = self.generation
+            gen.acquire()
+        g.generation = gen
+        g.start_time = time.monotonic()
+
+    def record_request(self, response):
+        if 'start_time' in g and request.endpoint is not None:
+            metrics.REQUEST_SECONDS.observe(time.monotonic()-g.start_time, request.endpoint)
+            metrics.REQUESTS.inc(request.endpoint, response.status_code)
+        return response
+
+    def release_generation(self, exc):
+        if 'generation' in g:
+            g.pop('generation').release()
+
+    def current(self):
+        return g.generation if 'generation' in g else self.generation
+
+    def reload(self):
+        ''' Start loading a new generation in the background. Returns False if a reload is already in progress. '''
+        if self.master_pid is not None:
+            # Worker process, master loads new generation and replaces workers
+            os.kill(self.master_pid, signal.SIGHUP)
+            return True
+        with self.lock:
+            if self.reloading:
+                return False
+            self.reloading = True
+        threading.Thread(target=self.load_generation, name='reload', daemon=True).start()
+        return True
+
+    def load_generation(self):
+        _LOGGER.info('Reloading')
+        try:
+            # Each generation uses its own jukebox, as the current one may still be in use
+            gen = generation.Generation(self.generation.number+1, musly.Musly(self.mus.libmusly, True), self.app_config, self.jukebox_path, self.neighbours_path)
+        except Exception as e:
+            _LOGGER.error('Reload failed - %s' % str(e))
+            with self.lock:
+                self.reloading = False
+            return False
+        with self.lock:
+            old = self.generation
+            self.generation = gen
+            self.reloading = False
+        old.retire()
+        _LOGGER.info('Reloaded, %d tracks' % len(gen.mta.paths))
+        return True
 
     def get_config(self):
         return self.app_config
 
     def get_musly(self):
-        return self.mus
+        return self.current().mus
 
     def get_mta(self):
-        return self.mta
+        return self.current().mta
+
+    def get_path_index(self):
+        return self.current().path_index
+
+    def get_metadata(self):
+        return self.current().metadata
+
+    def get_mix_cache(self):
+        return self.current().mix_cache
+
+    def get_similars(self, track_id):
+        return self.current().get_similars(track_id)
+
+    def get_all_similars(self, track_ids):
+        return self.current().get_all_similars(track_ids)
     
 musly_app = MuslyApp(__name__)
 
@@ -72,32 +138,73 @@ def get_value(params, key, defVal, isPost):
     return params[key][0] if key in params else defVal
 
 
-def decode(url, root):
-    u = urllib.parse.unquote(url)
-    if u.startswith('file://'):
-        u=u[7:]
-    elif u.startswith('tmp://'):
-        u=u[6:]
-    if u.startswith(root):
-        u=u[len(root):]
-    return cue.convert_from_cue_path(u)
-
-
-def genre_adjust(seed, entry, seed_genres, all_genres, match_all_genres):
-    if match_all_genres:
-        return 0.0
-    if 'genres' not in seed:
-        return 0.1
-    if 'genres' not in entry:
-        return 0.1
-    if seed['genres'][0]==entry['genres'][0]:
-        # Exact genre match
-        return 0.0
-    if (seed_genres is not None and entry['genres'][0] not in seed_genres) or \
-       (seed_genres is None and all_genres is not None and entry['genres'][0] in all_genres):
-        return 0.05
-    # Genre in group
-    return 0.025
+def choose_tracks(candidates, similarity_count, count, shuffle, timer):
+    ''' Make the random choices of a mix from its candidates, which are not modified '''
+    similar_tracks = list(candidates.similar)
+
+    # For each artist with several tracks randomly select one, keeping the similarity of the accepted track
+    for (pos, tracks) in candidates.matched:
+        _LOGGER.debug('Choosing random track for position %d (%d tracks)' % (pos, len(tracks)))
+        similar_tracks[pos] = (random.choice(tracks)[0], similar_tracks[pos][1])
+
+    # Too few tracks? Add some from the filtered lists
+    min_count = 2
+    for (name, filtered) in [('previous', candidates.by_previous), ('current', candidates.by_current), ('seeds', candidates.by_seeds)]:
+        if len(similar_tracks)<min_count and len(filtered)>0:
+            _LOGGER.debug('Add some tracks from filtered_by_%s_tracks, %d/%d' % (name, len(similar_tracks), len(filtered)))
+            similar_tracks = similar_tracks + sorted(filtered, key=lambda k: k[1])[:min_count-len(similar_tracks)]
+    timer.stage('fallback')
+
+    # Sort by similarity
+    similar_tracks = sorted(similar_tracks, key=lambda k: k[1])
+
+    # Take top 'similarity_count' tracks
+    similar_tracks = similar_tracks[:similarity_count]
+
+    if shuffle:
+        random.shuffle(similar_tracks)
+        similar_tracks = similar_tracks[:count]
+    timer.stage('shuffle')
+    return similar_tracks
+
+
+def add_seed_genres(cfg, meta, seed_genres):
+    ''' Add the genres from config groups that contain any of the seed's genres '''
+    if 'genres' in meta and 'genres' in cfg:
+        for genre in meta['genres']:
+            for group in cfg['genres']:
+                if genre in group:
+                    for cg in group:
+                        if not cg in seed_genres:
+                            seed_genres.append(cg)
+
+
+def stream_dump(paths, root, ids, sims, fmt):
+    ''' Yield dump response in chunks of tracks. JSON is written as one array, exactly as json.dumps would, ndjson
+        as one object per line. Only uses the objects passed in, as the request's generation is released before
+        the response is streamed. '''
+    as_json = fmt not in ['text', 'text-url', 'ndjson']
+    separator = ', ' if as_json else '\n'
+    if as_json:
+        yield '['
+    for start in range(0, len(ids), DUMP_STREAM_TRACKS):
+        lines = []
+        for track_id, sim in zip(ids[start:start+DUMP_STREAM_TRACKS], sims[start:start+DUMP_STREAM_TRACKS]):
+            path = paths[track_id]
+            sim = float(sim)
+            _LOGGER.debug("%s %s" % (path, sim))
+            if fmt=='text':
+                lines.append("%s\t%f" % (path, sim))
+            elif fmt=='text-url':
+                lines.append(cue.convert_to_cue_url('%s%s' % (root, path)))
+            else:
+                lines.append(json.dumps({'file':path, 'sim':sim}))
+        if fmt=='ndjson':
+            yield '\n'.join(lines)+'\n'
+        else:
+            yield ('' if start==0 else separator) + separator.join(lines)
+    if as_json:
+        yield ']'
 
 
 @musly_app.route('/api/dump', methods=['GET', 'POST'])
@@ -108,7 +215,8 @@ def dump_api():
     else:
         isPost = True
         params = request.get_json()
-        _LOGGER.debug('Request: %s' % json.dumps(params))
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug('Request: %s' % json.dumps(params))
 
     if not params:
         abort(400)
@@ -119,77 +227,72 @@ def dump_api():
     if len(params['track'])!=1:
         abort(400)
 
+    timer = metrics.StageTimer('dump_api', trace.NULL_TRACE)
     mta = musly_app.get_mta()
-    mus = musly_app.get_musly()
     cfg = musly_app.get_config()
-    meta_db = metadata_db.MetadataDb(cfg)
+    metadata = musly_app.get_metadata()
 
     # Strip LMS root path from track path
     root = cfg['paths']['lms']
 
-    track = decode(params['track'][0], root)
-    _LOGGER.debug('S TRACK %s -> %s' % (params['track'][0], track))
-
     # Check that musly knows about this track
-    track_id = -1
+    track_id = musly_app.get_path_index().get(params['track'][0])
+    _LOGGER.debug('S TRACK %s -> %d' % (params['track'][0], track_id))
+    if track_id<0:
+        abort(404)
     try:
-        track_id = mta.paths.index( track )
-        if track_id<0:
-            abort(404)
         fmt = get_value(params, 'format', '', isPost)
-        txt = fmt=='text'
-        txt_url = fmt=='text-url'
         match_artist = int(get_value(params, 'filterartist', '0', isPost))==1
-        meta = meta_db.get_metadata(track_id+1) # IDs (rowid) in SQLite are 1.. musly is 0..
-
-        all_genres = cfg['all_genres'] if 'all_genres' in cfg else None
+        meta = metadata.get_metadata(track_id)
         seed_genres=[]
-        if 'genres' in meta and 'genres' in cfg:
-            for genre in meta['genres']:
-                for group in cfg['genres']:
-                    if genre in group:
-                        for cg in group:
-                            if not cg in seed_genres:
-                                seed_genres.append(cg)
-
-        simtracks = mus.get_similars( mta.mtracks, mta.mtrackids, track_id )
-
-        resp=[]
-        prev_id=-1
+        add_seed_genres(cfg, meta, seed_genres)
+        seed_genre_mask = metadata.get_genre_mask(seed_genres)
+        match_all_genres = ('ignoregenre' in cfg) and (('*'==cfg['ignoregenre'][0]) or (meta['artist'] in cfg['ignoregenre']))
+
+        timer.stage('resolve')
+        simtracks = musly_app.get_similars(track_id)
+        timer.stage('similarity')
+
         count = int(get_value(params, 'count', 1000, isPost))
 
-        tracks=[]
-        for simtrack in simtracks:
-            if simtrack['id']==prev_id:
+        # Tracks are read most similar first, and as the genre adjustment only ever increases similarity, can stop
+        # once 'count' tracks have an adjusted similarity less than the similarity of the remaining tracks
+        chunk_size = max(count, DUMP_CHUNK_SIZE)
+        all_ids = []
+        all_sims = []
+        all_adjusted = []
+        accepted = 0
+        start = 0
+        while start<len(simtracks):
+            (ids, sims) = simtracks.get(start, start+chunk_size)
+            if len(ids)==0:
                 break
-            prev_id=simtrack['id']
-            if math.isnan(simtrack['sim']):
-                continue
-
-            track = meta_db.get_metadata(simtrack['id']+1)
-            if match_artist and track['artist'] != meta['artist']:
-                continue
-            if not match_artist and track['ignore']:
-                continue
-            match_all_genres = ('ignoregenre' in cfg) and (('*'==cfg['ignoregenre'][0]) or (meta is not None and meta['artist'] in cfg['ignoregenre']))
-            sim = simtrack['sim'] + genre_adjust(meta, track, seed_genres, all_genres, match_all_genres)
-            tracks.append({'path':mta.paths[simtrack['id']], 'sim':sim})
-
-        tracks = sorted(tracks, key=lambda k: k['sim'])
-        for track in tracks:
-            _LOGGER.debug("%s %s" % (track['path'], track['sim']))
-            if txt:
-                resp.append("%s\t%f" % (track['path'], track['sim']))
-            elif txt_url:
-                resp.append(cue.convert_to_cue_url('%s%s' % (root, track['path'])))
+            start += len(ids)
+            last_sim = sims[-1]
+            keep = ~numpy.isnan(sims) & metadata.valid[ids]
+            if match_artist:
+                keep &= metadata.artists[ids]==metadata.artists[track_id]
             else:
-                resp.append({'file':track['path'], 'sim':track['sim']})
-            if len(resp)>=count:
-                break
-        if txt or txt_url:
-            return '\n'.join(resp)
-        else:
-            return json.dumps(resp)
+                keep &= ~metadata.ignore[ids]
+            ids = ids[keep]
+            sims = sims[keep].astype(numpy.float64)
+            all_ids.append(ids)
+            all_sims.append(sims)
+            all_adjusted.append(sims + filters.genre_adjust(metadata, track_id, seed_genre_mask, ids, match_all_genres))
+            accepted += len(ids)
+            if accepted>=count and count>0:
+                if numpy.isnan(last_sim) or numpy.partition(numpy.concatenate(all_adjusted), count-1)[count-1]<last_sim:
+                    break
+
+        ids = numpy.concatenate(all_ids) if len(all_ids)>0 else numpy.empty(0, dtype=numpy.intp)
+        sims = numpy.concatenate(all_sims) if len(all_sims)>0 else numpy.empty(0)
+        sims_adjusted = numpy.concatenate(all_adjusted) if len(all_adjusted)>0 else numpy.empty(0)
+        timer.stage('filter')
+
+        # Sort by adjusted similarity, then by similarity and ID - i.e. the order musly returned tracks
+        order = numpy.lexsort((ids, sims, sims_adjusted))[:count]
+        timer.stage('sort')
+        return Response(stream_dump(mta.paths, root, ids[order], sims_adjusted[order], fmt), mimetype='application/x-ndjson' if fmt=='ndjson' else None)
     except Exception as e:
         _LOGGER.error("EX:%s" % str(e))
         abort(404)
@@ -203,7 +306,8 @@ def similar_api():
     else:
         isPost = True
         params = request.get_json()
-        _LOGGER.debug('Request: %s' % json.dumps(params))
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug('Request: %s' % json.dumps(params))
 
     if not params:
         abort(400)
@@ -225,6 +329,8 @@ def similar_api():
     no_repeat_artist = int(get_value(params, 'norepart', 0, isPost))
     no_repeat_album = int(get_value(params, 'norepalb', 0, isPost))
     exclude_christmas = int(get_value(params, 'filterxmas', '0', isPost))==1 and datetime.now().month!=12
+    tr = trace.Trace() if int(get_value(params, 'explain', '0', isPost))==1 else trace.NULL_TRACE
+    timer = metrics.StageTimer('similar_api', tr)
 
     if no_repeat_artist<0 or no_repeat_artist>200:
         no_repeat_artist = DEFAULT_NUM_PREV_TRACKS_FILTER_ARTIST
@@ -234,9 +340,8 @@ def similar_api():
     no_repeat_artist_or_album = no_repeat_album if no_repeat_album>no_repeat_artist else no_repeat_artist
 
     mta = musly_app.get_mta()
-    mus = musly_app.get_musly()
     cfg = musly_app.get_config()
-    meta_db = metadata_db.MetadataDb(cfg)
+    metadata = musly_app.get_metadata()
 
     # Strip LMS root path from track path
     root = cfg['paths']['lms']
@@ -249,191 +354,237 @@ def similar_api():
     filtered_by_seeds_tracks=[]
     filtered_by_current_tracks=[]
     filtered_by_previous_tracks=[]
-    current_titles=[]
+    current_titles=set()
 
     # Artist/album of seed tracks
-    seed_metadata=[]
+    seed_ids_with_metadata=[]
     track_id_seed_metadata={} # Map from seed track's ID to its metadata
     seed_genres=[]
-    all_genres = cfg['all_genres'] if 'all_genres' in cfg else None
     
     # Artist/album of chosen tracks
-    current_metadata_keys={}
-    current_metadata=[]
+    current_artists=set()
+    current_albums=set()
+    various_artists=set(metadata.artist_ids_of(filters.VARIOUS_ARTISTS))
 
     if min_duration>0 or max_duration>0:
         _LOGGER.debug('Duration:%d .. %d' % (min_duration, max_duration))
 
     # Musly IDs of seed tracks
     track_ids = []
-    for trk in params['track']:
-        track = decode(trk, root)
-        _LOGGER.debug('S TRACK %s -> %s' % (trk, track))
+    pindex = musly_app.get_path_index()
+    for trk, track_id in zip(params['track'], pindex.resolve(params['track'])):
+        _LOGGER.debug('S TRACK %s -> %d' % (trk, track_id))
 
         # Check that musly knows about this track
-        track_id = -1
-        try:
-            track_id = mta.paths.index( track )
-            _LOGGER.debug('Get %d similar track(s) to %s, index: %d' % (count, track, track_id))
-        except:
-            pass
-        if track_id is not None and track_id>=0:
+        if track_id>=0:
+            _LOGGER.debug('Get %d similar track(s) to %s, index: %d' % (count, trk, track_id))
             track_ids.append(track_id)
-            meta = meta_db.get_metadata(track_id+1) # IDs (rowid) in SQLite are 1.. musly is 0..
-            _LOGGER.debug('Seed %d metadata:%s' % (track_id, json.dumps(meta)))
+            meta = metadata.get_metadata(track_id)
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug('Seed %d metadata:%s' % (track_id, json.dumps(meta)))
             if meta is not None:
-                seed_metadata.append(meta)
+                seed_ids_with_metadata.append(track_id)
                 track_id_seed_metadata[track_id]=meta
                 # Get genres for this seed track - this takes its genres and gets any matching genres from config
-                if 'genres' in meta and 'genres' in cfg:
-                    for genre in meta['genres']:
-                        for group in cfg['genres']:
-                            if genre in group:
-                                for cg in group:
-                                    if not cg in seed_genres:
-                                        seed_genres.append(cg)
-                if 'title' in meta:
-                    current_titles.append(meta['title'])
+                add_seed_genres(cfg, meta, seed_genres)
+                current_titles.add(int(metadata.titles[track_id]))
         else:
-            _LOGGER.debug('Could not locate %s in DB' % track)
+            _LOGGER.debug('Could not locate %s in DB' % trk)
 
+    previous_ids = []
     previous_track_ids = set()
-    previous_metadata = [] # Ignore tracks with same meta-data, i.e. artist
+    previous_ids_with_metadata = [] # Ignore tracks with same meta-data, i.e. artist
     if 'previous' in params:
-        for trk in params['previous']:
-            track = decode(trk, root)
-            _LOGGER.debug('I TRACK %s -> %s' % (trk, track))
+        for trk, track_id in zip(params['previous'], pindex.resolve(params['previous'])):
+            _LOGGER.debug('I TRACK %s -> %d' % (trk, track_id))
 
             # Check that musly knows about this track
-            track_id = -1
-            try:
-                track_id = mta.paths.index(track)
-            except:
-                pass
-            if track_id is not None and track_id>=0:
+            if track_id>=0:
+                previous_ids.append(track_id)
                 previous_track_ids.add(track_id)
-                if len(previous_metadata)<no_repeat_artist_or_album:
-                    meta = meta_db.get_metadata(track_id+1) # IDs (rowid) in SQLite are 1.. musly is 0..
-                    if meta:
-                        previous_metadata.append(meta)
-                        if 'title' in meta:
-                            current_titles.append(meta['title'])
+                if len(previous_ids_with_metadata)<no_repeat_artist_or_album and metadata.valid[track_id]:
+                    previous_ids_with_metadata.append(track_id)
+                    current_titles.add(int(metadata.titles[track_id]))
             else:
-                _LOGGER.debug('Could not locate %s in DB' % track)
+                _LOGGER.debug('Could not locate %s in DB' % trk)
         _LOGGER.debug('Have %d previous tracks' % len(previous_track_ids))
 
     if match_genre:
         _LOGGER.debug('Seed genres: %s' % seed_genres)
+    seed_genre_mask = metadata.get_genre_mask(seed_genres)
+    excluded_ids = numpy.array(sorted(set(track_ids) | previous_track_ids), dtype=numpy.intp)
 
     similarity_count = int(count * SHUFFLE_FACTOR) if shuffle else count
-
-    matched_artists={}
-    for track_id in track_ids:
-        match_all_genres = ('ignoregenre' in cfg) and (('*'==cfg['ignoregenre'][0]) or ((track_id in track_id_seed_metadata) and (track_id_seed_metadata[track_id]['artist'] in cfg['ignoregenre'])))
-
+    chunk_size = similarity_count * NUM_SIMILAR_TRACKS_FACTOR
+
+    # Candidates only depend upon these inputs, so identical requests can re-use them. Explain needs the details
+    # of each candidate, so is never cached.
+    mix_cache = musly_app.get_mix_cache()
+    cache_key = None
+    candidates = None
+    if mix_cache.enabled() and not tr.enabled:
+        cache_key = mixcache.get_key(track_ids, previous_ids, (match_genre, exclude_christmas, max_similarity, min_duration, max_duration, no_repeat_artist, no_repeat_album, similarity_count))
+        candidates = mix_cache.get(cache_key)
+    timer.stage('resolve')
+
+    if candidates is None:
         # Query musly for similar tracks
-        _LOGGER.debug('Query musly for similar tracks to index: %d' % track_id)
-        simtracks = mus.get_similars( mta.mtracks, mta.mtrackids, track_id )
-
-        accepted_tracks = 0
-        for simtrack in simtracks:
-            if math.isnan(simtrack['sim']):
-                continue
-            if (not simtrack['id'] in track_ids) and (not simtrack['id'] in previous_track_ids) and (not simtrack['id'] in similar_track_ids) and (simtrack['sim']>0.0) and (simtrack['sim']<=max_similarity):
-                similar_track_ids.add(simtrack['id'])
-
-                meta = meta_db.get_metadata(simtrack['id']+1) # IDs (rowid) in SQLite are 1.. musly is 0..
-                if not meta:
-                    _LOGGER.debug('DISCARD(not found) ID:%d Path:%s Similarity:%f' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim']))
-                elif meta['ignore']:
-                    _LOGGER.debug('DISCARD(ignore) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim'], json.dumps(meta)))
-                elif (min_duration>0 or max_duration>0) and not filters.check_duration(min_duration, max_duration, meta):
-                    _LOGGER.debug('DISCARD(duration) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim'], json.dumps(meta)))
-                elif match_genre and not match_all_genres and not filters.genre_matches(cfg, seed_genres, meta):
-                    _LOGGER.debug('DISCARD(genre) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim'], json.dumps(meta)))
-                elif exclude_christmas and filters.is_christmas(meta):
-                    _LOGGER.debug('DISCARD(xmas) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim'], json.dumps(meta)))
-                else:
-                    if filters.same_artist_or_album(seed_metadata, meta):
-                        _LOGGER.debug('FILTERED(seeds) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim'], json.dumps(meta)))
-                        filtered_by_seeds_tracks.append({'path':mta.paths[simtrack['id']], 'similarity':simtrack['sim']})
-                    elif filters.same_artist_or_album(current_metadata, meta):
-                        _LOGGER.debug('FILTERED(current) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim'], json.dumps(meta)))
-                        filtered_by_current_tracks.append({'path':mta.paths[simtrack['id']], 'similarity':simtrack['sim']})
-                        if meta['artist'] in matched_artists and simtrack['sim'] - matched_artists[meta['artist']]['similarity'] <= 0.2:
-                            matched_artists[meta['artist']]['tracks'].append({'path':mta.paths[simtrack['id']], 'similarity':simtrack['sim']})
-                    elif no_repeat_artist>0 and filters.same_artist_or_album(previous_metadata, meta, False, no_repeat_artist):
-                        _LOGGER.debug('FILTERED(previous(artist)) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim'], json.dumps(meta)))
-                        filtered_by_previous_tracks.append({'path':mta.paths[simtrack['id']], 'similarity':simtrack['sim']})
-                    elif no_repeat_album>0 and filters.same_artist_or_album(previous_metadata, meta, True, no_repeat_album):
-                        _LOGGER.debug('FILTERED(previous(album)) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim'], json.dumps(meta)))
-                    elif filters.match_title(current_titles, meta):
-                        _LOGGER.debug('FILTERED(title) ID:%d Path:%s Similarity:%f Meta:%s' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim'], json.dumps(meta)))
-                        filtered_by_previous_tracks.append({'path':mta.paths[simtrack['id']], 'similarity':simtrack['sim']})
+        _LOGGER.debug('Query musly for similar tracks to: %s' % track_ids)
+        all_simtracks = musly_app.get_all_similars(track_ids)
+        timer.stage('similarity')
+        scanned_tracks = 0
+        total_accepted = 0
+
+        matched_artists={}
+        for track_id, simtracks in zip(track_ids, all_simtracks):
+            match_all_genres = ('ignoregenre' in cfg) and (('*'==cfg['ignoregenre'][0]) or ((track_id in track_id_seed_metadata) and (track_id_seed_metadata[track_id]['artist'] in cfg['ignoregenre'])))
+            # Genre adjustment does not depend upon the seed's genre here - all accepted tracks get the same
+            # adjustment, this matches the original behaviour (where the list of seeds was passed)
+            sim_adjust = 0.0 if match_all_genres else 0.1
+
+            accepted_tracks = 0
+            start = 0
+            while simtracks is not None and accepted_tracks<similarity_count and start<len(simtracks):
+                (ids, sims) = simtracks.get(start, start+chunk_size)
+                if len(ids)==0:
+                    break
+                start += len(ids)
+                scanned_tracks += len(ids)
+
+                # Filter out seeds, previous, and those outside of similarity range. NaN similarities fail these checks
+                keep = (sims>0.0) & (sims<=max_similarity) & ~numpy.isin(ids, excluded_ids)
+                if tr.enabled:
+                    tr.excluded(track_id, len(ids)-numpy.count_nonzero(keep))
+                ids = ids[keep]
+                sims = sims[keep]
+
+                # Tracks that are not to be used at all...
+                discards = [('ignore', ~metadata.valid[ids] | metadata.ignore[ids])]
+                if min_duration>0 or max_duration>0:
+                    discards.append(('duration', ~filters.check_duration(metadata, min_duration, max_duration, ids)))
+                if match_genre and not match_all_genres:
+                    discards.append(('genre', ~filters.genre_matches(cfg, metadata, seed_genre_mask, ids)))
+                if exclude_christmas:
+                    discards.append(('christmas', filters.is_christmas(metadata, ids)))
+                discard = discards[0][1]
+                for (reason, mask) in discards[1:]:
+                    discard = discard | mask
+
+                # ...and those that are filtered, but might be used if there are too few tracks
+                by_seeds = filters.same_artist_or_album(metadata, seed_ids_with_metadata, ids)
+                by_previous_artist = filters.same_artist_or_album(metadata, previous_ids_with_metadata[:no_repeat_artist], ids) if no_repeat_artist>0 else None
+                by_previous_album = filters.same_artist_or_album(metadata, previous_ids_with_metadata[:no_repeat_album], ids, True) if no_repeat_album>0 else None
+
+                # Remaining checks depend upon the tracks already chosen, so these are done in order
+                last = len(ids)-1
+                for pos in numpy.flatnonzero(~discard):
+                    simtrack_id = int(ids[pos])
+                    if simtrack_id in similar_track_ids:
+                        continue
+                    similar_track_ids.add(simtrack_id)
+                    simtrack_sim = float(sims[pos])
+                    artist = int(metadata.artists[simtrack_id])
+                    albumartist = int(metadata.albumartists[simtrack_id])
+                    album = (int(metadata.albums[simtrack_id]), albumartist)
+
+                    if by_seeds[pos]:
+                        filtered_by_seeds_tracks.append((simtrack_id, simtrack_sim))
+                        if tr.enabled:
+                            tr.candidate(track_id, simtrack_id, simtrack_sim, 'filtered', 'seeds')
+                    elif artist in current_artists or (album in current_albums and albumartist not in various_artists):
+                        filtered_by_current_tracks.append((simtrack_id, simtrack_sim))
+                        if artist in matched_artists and simtrack_sim - matched_artists[artist]['similarity'] <= 0.2:
+                            matched_artists[artist]['tracks'].append((simtrack_id, simtrack_sim))
+                        if tr.enabled:
+                            tr.candidate(track_id, simtrack_id, simtrack_sim, 'filtered', 'current')
+                    elif by_previous_artist is not None and by_previous_artist[pos]:
+                        filtered_by_previous_tracks.append((simtrack_id, simtrack_sim))
+                        if tr.enabled:
+                            tr.candidate(track_id, simtrack_id, simtrack_sim, 'filtered', 'previous-artist')
+                    elif by_previous_album is not None and by_previous_album[pos]:
+                        if tr.enabled:
+                            tr.candidate(track_id, simtrack_id, simtrack_sim, 'discarded', 'previous-album')
+                    elif int(metadata.titles[simtrack_id]) in current_titles:
+                        filtered_by_previous_tracks.append((simtrack_id, simtrack_sim))
+                        if tr.enabled:
+                            tr.candidate(track_id, simtrack_id, simtrack_sim, 'filtered', 'title')
                     else:
-                        key = '%s::%s::%s' % (meta['artist'], meta['album'], meta['albumartist'] if 'albumartist' in meta and meta['albumartist'] is not None else '')
-                        if not key in current_metadata_keys:
-                            current_metadata_keys[key]=1
-                            current_metadata.append(meta)
-                        sim = simtrack['sim'] + genre_adjust(seed_metadata, meta, seed_genres, all_genres, match_all_genres)
-
-                        _LOGGER.debug('USABLE ID:%d Path:%s Similarity:%f AdjSim:%s Meta:%s' % (simtrack['id'], mta.paths[simtrack['id']], simtrack['sim'], sim, json.dumps(meta)))
-                        similar_tracks.append({'path':mta.paths[simtrack['id']], 'similarity':sim})
+                        if tr.enabled:
+                            tr.candidate(track_id, simtrack_id, simtrack_sim, 'accepted')
+                        current_artists.add(artist)
+                        current_albums.add(album)
+                        sim = simtrack_sim + sim_adjust
+                        similar_tracks.append((simtrack_id, sim))
                         # Keep list of all tracks of an artist, so that we can randomly select one => we don't always use the same one
-                        matched_artists[meta['artist']]={'similarity':simtrack['sim'], 'tracks':[{'path':mta.paths[simtrack['id']], 'similarity':sim}], 'pos':len(similar_tracks)-1}
-                        if 'title' in meta:
-                            current_titles.append(meta['title'])
+                        matched_artists[artist]={'similarity':simtrack_sim, 'tracks':[(simtrack_id, sim)], 'pos':len(similar_tracks)-1}
+                        current_titles.add(int(metadata.titles[simtrack_id]))
                         accepted_tracks += 1
                         if accepted_tracks>=similarity_count:
+                            last = pos
                             break
 
-    # For each matched_artists randonly select a track...
-    for matched in matched_artists:
-        if len(matched_artists[matched]['tracks'])>1:
-            _LOGGER.debug('Choosing random track for %s (%d tracks)' % (matched, len(matched_artists[matched]['tracks'])))
-            sim = similar_tracks[matched_artists[matched]['pos']]['similarity']
-            similar_tracks[matched_artists[matched]['pos']] = random.choice(matched_artists[matched]['tracks'])
-            similar_tracks[matched_artists[matched]['pos']]['similarity'] = sim
+                # Discarded tracks, up to the last one checked, are also marked as used
+                similar_track_ids.update(ids[:last+1][discard[:last+1]].tolist())
+                if tr.enabled:
+                    checked = discard[:last+1]
+                    tr.discarded(track_id, ids[:last+1][checked], sims[:last+1][checked], [(reason, mask[:last+1][checked]) for (reason, mask) in discards])
+                _LOGGER.debug('Seed %d, checked %d tracks, discarded %d, accepted %d' % (track_id, last+1, numpy.count_nonzero(discard[:last+1]), accepted_tracks))
+            total_accepted += accepted_tracks
 
-    # Too few tracks? Add some from the filtered lists
-    min_count = 2
-    if len(similar_tracks)<min_count and len(filtered_by_previous_tracks)>0:
-        _LOGGER.debug('Add some tracks from filtered_by_previous_tracks, %d/%d' % (len(similar_tracks), len(filtered_by_previous_tracks)))
-        filtered_by_previous_tracks = sorted(filtered_by_previous_tracks, key=lambda k: k['similarity'])
-        similar_tracks = similar_tracks + filtered_by_previous_tracks[:min_count-len(similar_tracks)]
-    if len(similar_tracks)<min_count and len(filtered_by_current_tracks)>0:
-        _LOGGER.debug('Add some tracks from filtered_by_current_tracks, %d/%d' % (len(similar_tracks), len(filtered_by_current_tracks)))
-        filtered_by_current_tracks = sorted(filtered_by_current_tracks, key=lambda k: k['similarity'])
-        similar_tracks = similar_tracks + filtered_by_current_tracks[:min_count-len(similar_tracks)]
-    if len(similar_tracks)<min_count and len(filtered_by_seeds_tracks)>0:
-        _LOGGER.debug('Add some tracks from filtered_by_seeds_tracks, %d/%d' % (len(similar_tracks), len(filtered_by_seeds_tracks)))
-        filtered_by_seeds_tracks = sorted(filtered_by_seeds_tracks, key=lambda k: k['similarity'])
-        similar_tracks = similar_tracks + filtered_by_seeds_tracks[:min_count-len(similar_tracks)]
+        metrics.CANDIDATES.inc('scanned', amount=scanned_tracks)
+        metrics.CANDIDATES.inc('accepted', amount=total_accepted)
+        timer.stage('filter')
 
-    # Sort by similarity
-    similar_tracks = sorted(similar_tracks, key=lambda k: k['similarity'])
-    
-    # Take top 'similarity_count' tracks
-    similar_tracks = similar_tracks[:similarity_count]
+        matched = [(m['pos'], m['tracks']) for m in matched_artists.values() if len(m['tracks'])>1]
+        candidates = mixcache.MixCandidates(similar_tracks, matched, filtered_by_previous_tracks, filtered_by_current_tracks, filtered_by_seeds_tracks)
+        if cache_key is not None:
+            mix_cache.put(cache_key, candidates)
 
-    if shuffle:
-        random.shuffle(similar_tracks)
-        similar_tracks = similar_tracks[:count]
+    similar_tracks = choose_tracks(candidates, similarity_count, count, shuffle, timer)
 
     track_list = []
-    for track in similar_tracks:
-        path = '%s%s' % (root, track['path'])
+    for (track_id, sim) in similar_tracks:
+        path = '%s%s' % (root, mta.paths[track_id])
         track_list.append(cue.convert_to_cue_url(path))
-        _LOGGER.debug('Path:%s %f' % (path, track['similarity']))
+        _LOGGER.debug('Path:%s %f' % (path, sim))
 
-    meta_db.close()
+    if tr.enabled:
+        timer.stage('serialize')
+        return json.dumps({'tracks':track_list, 'explain':tr.to_dict(mta.paths)})
     if get_value(params, 'format', '', isPost)=='text':
-        return '\n'.join(track_list)
+        resp = '\n'.join(track_list)
     else:
-        return json.dumps(track_list)
+        resp = json.dumps(track_list)
+    timer.stage('serialize')
+    return resp
+
+
+@musly_app.route('/api/metrics', methods=['GET'])
+def metrics_api():
+    metrics.update_generation(musly_app.current())
+    return metrics.render(), 200, {'Content-Type':'text/plain; version=0.0.4; charset=utf-8'}
 
 
-def start_app(args, mus, config, jukebox_path):
-    musly_app.init(args, mus, config, jukebox_path)
+@musly_app.route('/api/reload', methods=['POST'])
+def reload_api():
+    token = musly_app.get_config()['reloadtoken'] if 'reloadtoken' in musly_app.get_config() else None
+    if not token:
+        abort(404)
+    auth = request.headers.get('Authorization', '')
+    # Only accepted as a header, query strings are written to access logs
+    supplied = auth[7:] if auth.startswith('Bearer ') else ''
+    if not hmac.compare_digest(supplied.encode('utf-8'), token.encode('utf-8')):
+        abort(403)
+    if not musly_app.reload():
+        return json.dumps({'status':'busy'}), 409
+    return json.dumps({'status':'reloading'}), 202
+
+
+def start_app(args, mus, config, jukebox_path, neighbours_path):
+    musly_app.init(args, mus, config, jukebox_path, neighbours_path)
     _LOGGER.debug('Ready to process requests')
-    musly_app.run(host=config['host'], port=config['port'])
+    if args.workers>0:
+        prefork.serve(musly_app, config['host'], config['port'], args.workers)
+    else:
+        signal.signal(signal.SIGHUP, lambda signum, frame: musly_app.reload())
+        musly_app.run(host=config['host'], port=config['port'])
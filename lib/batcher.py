@@ -0,0 +1,99 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging
+import threading
+import time
+from . import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Batch(object):
+    def __init__(self):
+        self.seeds = []
+        self.requests = 0
+        self.rows = None
+        self.error = None
+        self.started = 0.0
+        self.done = threading.Event()
+
+
+class SimilarityBatcher(object):
+    ''' Gather the seed tracks of concurrent requests over a short window, and calculate the similarities of
+        these together - so that a seed requested by several requests is only calculated once. The first
+        request of a batch waits for the window, and then calculates the batch; later requests wait for this. '''
+    def __init__(self, calc_similars, window):
+        self.calc_similars = calc_similars
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = None
+        self.batches = 0
+        self.requests = 0
+        self.seeds = 0
+        self.max_batch = 0
+        self.delay = 0.0
+        self.max_delay = 0.0
+
+
+    def get_similars(self, track_ids):
+        ''' Get SimilarTracks for each of track_ids '''
+        if self.window<=0:
+            return self.calc_similars(track_ids)
+
+        arrived = time.monotonic()
+        with self.lock:
+            batch = self.pending
+            leader = batch is None
+            if leader:
+                batch = Batch()
+                self.pending = batch
+            batch.requests += 1
+            for track_id in track_ids:
+                if track_id not in batch.seeds:
+                    batch.seeds.append(track_id)
+
+        if leader:
+            time.sleep(self.window)
+            with self.lock:
+                self.pending = None
+            batch.started = time.monotonic()
+            self.update_stats(batch)
+            try:
+                batch.rows = dict(zip(batch.seeds, self.calc_similars(batch.seeds)))
+            except Exception as e:
+                batch.error = e
+            batch.done.set()
+        else:
+            batch.done.wait()
+
+        delay = batch.started-arrived
+        with self.lock:
+            self.delay += delay
+            self.max_delay = max(self.max_delay, delay)
+        metrics.BATCH_DELAY_SECONDS.inc(amount=delay)
+        if batch.error is not None:
+            raise batch.error
+        return [batch.rows[track_id] for track_id in track_ids]
+
+
+    def update_stats(self, batch):
+        with self.lock:
+            self.batches += 1
+            self.requests += batch.requests
+            self.seeds += len(batch.seeds)
+            self.max_batch = max(self.max_batch, len(batch.seeds))
+        metrics.BATCHES.inc('batches')
+        metrics.BATCHES.inc('requests', amount=batch.requests)
+        metrics.BATCHES.inc('seeds', amount=len(batch.seeds))
+        _LOGGER.debug('Batch of %d seeds, from %d requests' % (len(batch.seeds), batch.requests))
+
+
+    def stats(self):
+        with self.lock:
+            return {'batches':self.batches, 'requests':self.requests, 'seeds':self.seeds, 'maxbatch':self.max_batch,
+                    'delay':self.delay, 'maxdelay':self.max_delay}
@@ -0,0 +1,224 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging
+import math
+import numpy
+import os
+import struct
+import time
+from . import features, jukebox, metadata_db, timbre
+
+_LOGGER = logging.getLogger(__name__)
+CLUSTERS_FILE = 'musly.clusters'
+
+# File layout: header, padded to DATA_OFFSET, then embedding centre and scale (float32[dim] each), cluster
+# centroids (float32[num_clusters*dim]), offset of each cluster's tracks (int32[num_clusters+1]), and track
+# IDs ordered by cluster (int32[num_tracks])
+MAGIC = b'MSCL'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIII') # magic, version, num_tracks, num_clusters, dim, features checksum
+DATA_OFFSET = 64
+MAX_ITERATIONS = 25
+ROWS_PER_CHUNK = 8192
+RECALL_SEEDS = 100
+
+
+def get_embeddings(models, track_ids=None):
+    ''' Cheap vector for each track's timbre model - the mean, and log of the variance of each dimension '''
+    (means, covars, logdets) = models
+    dim = means.shape[1]
+    (upper, lower) = numpy.triu_indices(dim)
+    diagonal = numpy.flatnonzero(upper==lower)
+    if track_ids is not None:
+        means = means[track_ids]
+        covars = covars[track_ids]
+    variances = numpy.maximum(covars[:, diagonal].astype(numpy.float32), 1e-10)
+    return numpy.hstack((means.astype(numpy.float32), numpy.log(variances)))
+
+
+def nearest_centroids(vectors, centroids):
+    ''' Index of nearest centroid to each vector '''
+    nearest = numpy.empty(len(vectors), dtype=numpy.int32)
+    norms = (centroids*centroids).sum(axis=1)
+    for start in range(0, len(vectors), ROWS_PER_CHUNK):
+        chunk = vectors[start:start+ROWS_PER_CHUNK]
+        nearest[start:start+len(chunk)] = numpy.argmin(norms[None, :]-2.0*(chunk@centroids.T), axis=1)
+    return nearest
+
+
+def kmeans(vectors, num_clusters):
+    ''' Lloyd's k-means, starting from a (fixed) random sample of the vectors. Empty clusters keep their centroid. '''
+    rng = numpy.random.default_rng(0)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+    assignments = None
+    for i in range(MAX_ITERATIONS):
+        nearest = nearest_centroids(vectors, centroids)
+        if assignments is not None and numpy.array_equal(nearest, assignments):
+            break
+        assignments = nearest
+        counts = numpy.bincount(assignments, minlength=num_clusters)
+        sums = numpy.zeros(centroids.shape)
+        numpy.add.at(sums, assignments, vectors)
+        used = counts>0
+        centroids[used] = sums[used]/counts[used, None]
+    _LOGGER.debug('k-means finished after %d iterations' % (i+1))
+    return (centroids, assignments)
+
+
+class ClusterIndex(object):
+    ''' Read-only, memory-mapped, index of tracks grouped into clusters of similar timbre '''
+    def __init__(self, path):
+        self.data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        if len(self.data)<DATA_OFFSET:
+            raise ValueError('File too small')
+        (magic, version, self.num_tracks, self.num_clusters, self.dim, self.checksum) = HEADER.unpack(self.data[:HEADER.size].tobytes())
+        if magic!=MAGIC or version!=VERSION:
+            raise ValueError('Unsupported file')
+        if len(self.data)!=DATA_OFFSET+(((2+self.num_clusters)*self.dim)+self.num_clusters+1+self.num_tracks)*4:
+            raise ValueError('Invalid file size')
+        floats = self.data[DATA_OFFSET:DATA_OFFSET+((2+self.num_clusters)*self.dim*4)].view(numpy.float32)
+        self.centre = floats[:self.dim]
+        self.scale = floats[self.dim:2*self.dim]
+        self.centroids = floats[2*self.dim:].reshape(self.num_clusters, self.dim)
+        ints = self.data[DATA_OFFSET+len(floats)*4:].view(numpy.int32)
+        self.offsets = ints[:self.num_clusters+1]
+        self.ids = ints[self.num_clusters+1:]
+        self.models = None
+
+
+    def is_current(self, num_tracks, checksum):
+        return self.num_tracks==num_tracks and self.checksum==checksum
+
+
+    def get_candidates(self, track_id, probes):
+        ''' IDs of the tracks in the 'probes' clusters nearest to track_id, in ID order '''
+        vector = (get_embeddings(self.models, [track_id])[0]-self.centre)/self.scale
+        dists = ((self.centroids-vector)**2).sum(axis=1)
+        if probes<self.num_clusters:
+            nearest = numpy.argpartition(dists, probes-1)[:probes]
+        else:
+            nearest = numpy.arange(self.num_clusters)
+        return numpy.sort(numpy.concatenate([self.ids[self.offsets[c]:self.offsets[c+1]] for c in nearest]))
+
+
+def get_path(config):
+    return os.path.join(config['paths']['db'], CLUSTERS_FILE)
+
+
+def get_checksum(meta_db, paths):
+    return features.get_checksum(paths, meta_db.get_setting('featuresid'))
+
+
+def load_index(config, mus, mtracks, checksum):
+    ''' Load index, if it exists and was created from the current features '''
+    path = get_path(config)
+    if config['clusters']<=0 or not os.path.exists(path):
+        return None
+    try:
+        index = ClusterIndex(path)
+        if index.is_current(len(mtracks), checksum):
+            index.models = timbre.get_models(mus, mtracks)
+        else:
+            _LOGGER.info('%s is out of date, similarities will be calculated for all tracks' % path)
+            return None
+    except Exception as e:
+        _LOGGER.error('Failed to read %s - %s' % (path, str(e)))
+        return None
+    _LOGGER.debug('Loaded %d clusters of %d tracks' % (index.num_clusters, index.num_tracks))
+    return index
+
+
+def build_index(mus, mtracks, checksum, path, num_clusters):
+    ''' Cluster tracks by the embedding of their timbre model, and write index '''
+    num_tracks = len(mtracks)
+    num_clusters = max(1, min(num_clusters, num_tracks))
+    _LOGGER.info('Clustering %d tracks into %d clusters' % (num_tracks, num_clusters))
+    vectors = get_embeddings(timbre.get_models(mus, mtracks))
+    centre = vectors.mean(axis=0)
+    scale = vectors.std(axis=0)
+    scale[scale<=0] = 1.0
+    vectors = (vectors-centre)/scale
+    (centroids, assignments) = kmeans(vectors, num_clusters)
+    ids = numpy.argsort(assignments, kind='stable').astype(numpy.int32)
+    offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(assignments, minlength=num_clusters)))).astype(numpy.int32)
+    tmp_path = path+'.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, num_tracks, num_clusters, vectors.shape[1], checksum).ljust(DATA_OFFSET, b'\0'))
+            for array in [centre, scale, centroids]:
+                f.write(array.astype(numpy.float32).tobytes())
+            f.write(offsets.tobytes())
+            f.write(ids.tobytes())
+        # Replace, rather than overwrite, so that a running server's mapping remains valid
+        os.replace(tmp_path, path)
+    except Exception as e:
+        _LOGGER.error('Failed to write %s - %s' % (path, str(e)))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    _LOGGER.info('Saved cluster index to %s' % path)
+    return True
+
+
+def update_index(mus, config, meta_db, paths, mtracks):
+    ''' (Re)build index after analysis, if enabled and not already current '''
+    if config['clusters']<=0 or len(paths)==0:
+        return
+    path = get_path(config)
+    checksum = get_checksum(meta_db, paths)
+    if os.path.exists(path):
+        try:
+            index = ClusterIndex(path)
+            if index.is_current(len(paths), checksum) and index.num_clusters==min(config['clusters'], len(paths)):
+                _LOGGER.info('Cluster index is already up to date')
+                return
+        except Exception as e:
+            _LOGGER.debug('Ignoring existing index - %s' % str(e))
+    build_index(mus, mtracks, checksum, path, config['clusters'])
+
+
+def check_recall(mus, config, jukebox_path, k):
+    ''' Compare the k most similar tracks found by probing clusters against those of an exact search,
+        for a range of probe counts '''
+    meta_db = metadata_db.MetadataDb(config)
+    (paths, mtracks) = features.load_tracks(mus, config, meta_db)
+    mtrackids = jukebox.update_jukebox(mus, config, meta_db, jukebox_path, paths, mtracks)
+    index = load_index(config, mus, mtracks, get_checksum(meta_db, paths))
+    meta_db.close()
+    if mtrackids is None:
+        _LOGGER.error('Failed to load jukebox')
+        return False
+    if index is None:
+        _LOGGER.error('No current cluster index, set clusters in config and run analysis')
+        return False
+
+    num_tracks = len(paths)
+    seeds = range(0, num_tracks, max(1, num_tracks//RECALL_SEEDS))
+    exact = []
+    start = time.monotonic()
+    for seed in seeds:
+        simtracks = mus.get_similars(mtracks, mtrackids, seed)
+        (ids, sims) = simtracks.get(0, k+1)
+        exact.append(set(int(i) for i in ids if i!=seed))
+    _LOGGER.info('Exact search: %.2fms per seed' % ((time.monotonic()-start)*1000.0/len(seeds)))
+
+    probes = sorted(set([2**p for p in range(int(math.log2(index.num_clusters))+1)] + [min(config['clusterprobes'], index.num_clusters)]))
+    for num_probes in probes:
+        found = 0
+        candidates = 0
+        start = time.monotonic()
+        for seed, expected in zip(seeds, exact):
+            ids = index.get_candidates(seed, num_probes)
+            sims = mus.get_similars_of(mtracks, seed, ids)
+            order = numpy.lexsort((ids, sims))[:k+1]
+            found += len(expected.intersection(int(i) for i in ids[order] if i!=seed))
+            candidates += len(ids)
+        secs = time.monotonic()-start
+        _LOGGER.info('Probes %4d%s: recall@%d %.3f, %.1f%% of tracks scored, %.2fms per seed' % (num_probes, '*' if num_probes==config['clusterprobes'] else ' ', k,
+                     found/max(1, sum(len(e) for e in exact)), candidates*100.0/(len(seeds)*num_tracks), secs*1000.0/len(seeds)))
+    return True
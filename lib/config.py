@@ -58,18 +58,56 @@ def read_config(path, analyse):
     if not 'threads' in config:
         config['threads']=os.cpu_count()
 
+    if not 'lowmemory' in config:
+        config['lowmemory']=False
+
+    if not 'simthreads' in config:
+        config['simthreads']=1 if config['lowmemory'] else min(4, os.cpu_count())
+
+    if not 'jukeboxes' in config:
+        config['jukeboxes']=1 if config['lowmemory'] else max(config['simthreads'], min(4, os.cpu_count()))
+
+    if not 'simengine' in config or config['simengine'] not in ['musly', 'numpy']:
+        config['simengine']='musly'
+
+    if not 'guessneighbors' in config:
+        config['guessneighbors']=0
+
+    if not 'clusters' in config:
+        config['clusters']=0
+
+    if not 'clusterprobes' in config:
+        config['clusterprobes']=8
+    elif config['clusterprobes']<1:
+        config['clusterprobes']=1
+
+    if not 'batchwindow' in config:
+        config['batchwindow']=2
+
     if not 'extractlen' in config:
         config['extractlen']=30
 
     if not 'extractstart' in config:
         config['extractstart']=-48
 
+    if not 'simcachesize' in config:
+        config['simcachesize']=(8 if config['lowmemory'] else 32)*1024*1024
+
+    if not 'mixcachesize' in config:
+        config['mixcachesize']=64 if config['lowmemory'] else 256
+
+    if not 'mixcachettl' in config:
+        config['mixcachettl']=300
+
     if not 'styletracks' in config:
         config['styletracks']=1000
 
     if not 'styletracksmethod' in config:
         config['styletracksmethod']='genres'
 
+    if not 'restylethreshold' in config:
+        config['restylethreshold']=20
+
     if 'genres' in config:
         config['all_genres']=[]
         for genres in config['genres']:
@@ -0,0 +1,106 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import ctypes
+import logging
+import numpy
+import os
+import struct
+import zlib
+
+_LOGGER = logging.getLogger(__name__)
+FEATURES_FILE = 'musly.features'
+
+# File layout: header, padded to DATA_OFFSET, then the musly track data of each track (in musly ID order)
+# with a fixed stride. Written from the DB, so that the server can memory-map this.
+MAGIC = b'MSFT'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIII') # magic, version, num_tracks, mtracksize, stride, checksum
+DATA_OFFSET = 64
+
+
+def get_checksum(paths, featuresid):
+    ''' Checksum of track paths, and ID of the features in the DB - which is changed each time tracks are analysed '''
+    crc = zlib.crc32(b'' if featuresid is None else featuresid.encode('ascii'))
+    for path in paths:
+        crc = zlib.crc32(path.encode('utf-8', 'surrogateescape'), crc)
+        crc = zlib.crc32(b'\n', crc)
+    return crc
+
+
+class FeatureFile(object):
+    ''' Read-only, memory-mapped, feature file '''
+    def __init__(self, path):
+        self.data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        if len(self.data)<DATA_OFFSET:
+            raise ValueError('File too small')
+        (magic, version, self.num_tracks, self.mtracksize, self.stride, self.checksum) = HEADER.unpack(self.data[:HEADER.size].tobytes())
+        if magic!=MAGIC or version!=VERSION:
+            raise ValueError('Unsupported file')
+        if len(self.data)!=DATA_OFFSET+(self.num_tracks*self.stride):
+            raise ValueError('Invalid file size')
+
+
+    def is_current(self, num_tracks, mtracksize, checksum):
+        return self.num_tracks==num_tracks and self.mtracksize==mtracksize and self.checksum==checksum
+
+
+    def get_mtracks(self, mus):
+        ''' Create array of musly_track pointers, pointing into the mapped file '''
+        return mus.get_mtracks(self.data, self.num_tracks, self.stride, DATA_OFFSET)
+
+
+def write_features(path, mus, cursor, num_tracks, checksum):
+    stride = ctypes.sizeof(mus.mtrack_type)
+    padding = b'\0' * stride
+    tmp_path = path+'.tmp'
+    written = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, num_tracks, mus.mtracksize, stride, checksum).ljust(DATA_OFFSET, b'\0'))
+            cursor.execute('SELECT vals, fmt FROM tracks ORDER BY rowid')
+            for row in cursor:
+                vals = memoryview(mus.get_track_vals(row))[:mus.mtracksize]
+                f.write(vals)
+                f.write(padding[len(vals):])
+                written += 1
+        if written!=num_tracks:
+            raise Exception('Tracks changed whilst writing (%d/%d)' % (written, num_tracks))
+        # Replace, rather than overwrite, so that a running server's mapping remains valid
+        os.replace(tmp_path, path)
+    except Exception as e:
+        _LOGGER.error('Failed to write %s - %s' % (path, str(e)))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
+
+
+def load_tracks(mus, config, meta_db):
+    ''' Get track paths, and musly tracks. The tracks are read from the feature file, which is (re)written
+        from the DB if it does not match. '''
+    path = os.path.join(config['paths']['db'], FEATURES_FILE)
+    cursor = meta_db.get_cursor()
+    paths = meta_db.get_paths()
+    checksum = get_checksum(paths, meta_db.get_setting('featuresid'))
+
+    ffile = None
+    if os.path.exists(path):
+        try:
+            ffile = FeatureFile(path)
+        except Exception as e:
+            _LOGGER.error('Failed to read %s - %s' % (path, str(e)))
+    if ffile is None or not ffile.is_current(len(paths), mus.mtracksize, checksum):
+        _LOGGER.info('Writing features of %d tracks to %s' % (len(paths), path))
+        ffile = None
+        if write_features(path, mus, cursor, len(paths), checksum):
+            ffile = FeatureFile(path)
+
+    if ffile is None:
+        return mus.get_alltracks_db(cursor)
+    _LOGGER.debug('Mapped features of %d tracks' % ffile.num_tracks)
+    return (paths, ffile.get_mtracks(mus))
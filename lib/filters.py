@@ -5,87 +5,68 @@
 # GPLv3 license.
 #
 
+import numpy
+
 VARIOUS_ARTISTS = ['various', 'various artists'] # Artist names are normalised, and coverted to lower case
 CHRISTMAS_GENRES = ['Christmas', 'Xmas']
 
-def same_artist_or_album(seeds, track, check_album_only=False, max_check=0):
-    check = 0
-    for seed in seeds:
-        if seed['artist']==track['artist'] and not check_album_only:
-            return True
-        if seed['album']==track['album'] and 'albumartist' in seed and 'albumartist' in track and seed['albumartist']==track['albumartist'] and track['albumartist'] not in VARIOUS_ARTISTS:
-            return True
-        check+=1
-        if max_check>0 and check>=max_check:
-            return False
-    return False
+# The functions below work on numpy arrays of track IDs, reading metadata from a MetadataStore, and
+# return a boolean array with an entry for each ID.
+
+def same_artist_or_album(metadata, seed_ids, ids, check_album_only=False):
+    ''' Tracks by the same artist, or from the same (non various artists) album, as any of seed_ids '''
+    seed_ids = numpy.asarray(seed_ids, dtype=numpy.intp)
+    if len(seed_ids)==0:
+        return numpy.zeros(len(ids), dtype=numpy.bool_)
+    various = metadata.artist_ids_of(VARIOUS_ARTISTS)
+    same = numpy.isin(metadata.album_keys(ids), metadata.album_keys(seed_ids)) & ~numpy.isin(metadata.albumartists[ids], various)
+    if not check_album_only:
+        same |= numpy.isin(metadata.artists[ids], metadata.artists[seed_ids])
+    return same
 
 
-def genre_matches(config, seed_genres, track):
-    if 'genres' not in track or len(track['genres'])<1:
-        return True # Track has no genre? Then can't filter out...
+def genre_matches(config, metadata, seed_genre_mask, ids):
+    ''' Tracks with a genre in seed genres, or any track without a genre or with an ignoregenre artist '''
+    has_genre = metadata.genre_offsets[ids+1]>metadata.genre_offsets[ids]
+    matches = ~has_genre
 
     # Ignore genre for an artist?
-    if 'ignoregenre' in config and track['artist'] in config['ignoregenre']:
-        return True
+    if 'ignoregenre' in config:
+        matches |= numpy.isin(metadata.artists[ids], metadata.artist_ids_of(config['ignoregenre']))
 
-    if len(seed_genres)<1:
-        # No filtering for seed track genres
+    if not seed_genre_mask.any():
+        # No filtering for seed track genres, so only filter out tracks whose genre is in config list
         if 'all_genres' in config:
-            for tg in track['genres']:
-                if tg in config['all_genres']:
-                    # Track's genre is in config list, but not in seeds, so filter out track
-                    return False
-        # No seed genres, and track's genre not in filters, so accept track
-        return True
-
-    for sg in seed_genres:
-        if sg in track['genres']:
-            return True
-
-    return False
-
-
-def is_christmas(track):
-    if 'genres' in track and len(track['genres'])>=0:
-        for genre in track['genres']:
-            if genre in CHRISTMAS_GENRES:
-                return True
-
-    return False
-
-
-def match_artist(artists, track):
-    for artist in artists:
-        if artist==track['artist'] or ('albumartist' in track and artist==track['albumartist']):
-            return True
-    return False
-
-
-def match_album(albums, track):
-    if (not 'album' in track) or ( ('albumartist' not in track) and ('artist' not in track)):
-        return False
-
-    album = '%s - %s' % (track['albumartist'] if 'albumartist' in track else track['artist'], track['album'])
-    return album in albums
-
-
-def match_title(titles, track):
-    if not 'title' in track:
-        return False
-
-    return track['title'] in titles 
-
-
-def check_duration(min_duration, max_duration, meta):
-    if 'duration' not in meta or meta['duration'] is None or meta['duration']<=0:
-        return True # No duration to check!
-
-    if min_duration>0 and meta['duration']<min_duration:
-        return False
-
-    if max_duration>0 and meta['duration']>max_duration:
-        return False
-
-    return True
-
+            return matches | ~metadata.has_genre(ids, metadata.get_genre_mask(config['all_genres']))
+        return numpy.ones(len(ids), dtype=numpy.bool_)
+
+    return matches | metadata.has_genre(ids, seed_genre_mask)
+
+
+def is_christmas(metadata, ids):
+    return metadata.has_genre(ids, metadata.get_genre_mask(CHRISTMAS_GENRES))
+
+
+def check_duration(metadata, min_duration, max_duration, ids):
+    ''' Tracks without a duration are always accepted '''
+    durations = metadata.durations[ids]
+    ok = numpy.ones(len(ids), dtype=numpy.bool_)
+    if min_duration>0:
+        ok &= (durations<=0) | (durations>=min_duration)
+    if max_duration>0:
+        ok &= (durations<=0) | (durations<=max_duration)
+    return ok
+
+
+def genre_adjust(metadata, seed_id, seed_genre_mask, ids, match_all_genres):
+    ''' Amount to add to similarity, to favour tracks with the same genre as the seed '''
+    if match_all_genres:
+        return numpy.zeros(len(ids))
+    seed_genre = metadata.first_genres[seed_id] if seed_id is not None and seed_id>=0 else -1
+    genres = metadata.first_genres[ids]
+    if seed_genre<0:
+        return numpy.full(len(ids), 0.1)
+    adjust = numpy.where(seed_genre_mask[numpy.maximum(genres, 0)], 0.025, 0.05) # Genre in group, or not
+    adjust[genres==seed_genre] = 0.0 # Exact genre match
+    adjust[genres<0] = 0.1
+    return adjust
@@ -0,0 +1,48 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def get_rss():
+    ''' Resident memory, in bytes, of this process - or None if not known (Linux only) '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except:
+        return None
+
+
+class Footprint(object):
+    ''' Measure the change in resident memory whilst each component is loaded. Memory-mapped files only
+        count the pages that have been read so far. '''
+    def __init__(self):
+        self.components = []
+        self.start = get_rss()
+        self.last = self.start
+
+
+    def measure(self, name):
+        ''' Record the change since the previous component '''
+        rss = get_rss()
+        if rss is not None and self.last is not None:
+            self.components.append((name, rss-self.last))
+        self.last = rss
+
+
+    def total(self):
+        return 0 if self.last is None or self.start is None else self.last-self.start
+
+
+    def log(self):
+        if self.last is None:
+            return
+        _LOGGER.info('Resident memory %.1fMB, loading used %.1fMB (%s)' % (self.last/1048576.0, self.total()/1048576.0,
+                     ', '.join('%s %.1fMB' % (name, size/1048576.0) for (name, size) in self.components)))
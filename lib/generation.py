@@ -0,0 +1,261 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import functools
+import logging
+import numpy
+import sqlite3
+import threading
+import time
+from . import batcher, clusters, features, footprint, jukebox, metadata_db, metadata_store, metrics, mixcache, musly, neighbours, path_index, simcache, timbre
+
+_LOGGER = logging.getLogger(__name__)
+GUESS_RECALL_INTERVAL = 100 # Check recall of every Nth guess against all similarities
+
+
+def open_db(app_config, jukebox_path):
+    ''' Open DB read-only, unless it needs to be updated - or the jukebox needs to be updated to match it '''
+    try:
+        meta_db = metadata_db.MetadataDb(app_config, True)
+        if not meta_db.needs_update() and jukebox.is_current(meta_db, jukebox_path, meta_db.get_paths()):
+            return meta_db
+        meta_db.close()
+    except sqlite3.Error as e:
+        _LOGGER.debug('Failed to open DB read-only - %s' % str(e))
+    meta_db = metadata_db.MetadataDb(app_config)
+    meta_db.update_normalized()
+    meta_db.update_vals_format()
+    return meta_db
+
+
+def load_jukebox(mus, app_config, meta_db, jukebox_path, paths, tracks):
+    ''' Load jukebox, adding any new tracks. The DB is only opened read-only if the jukebox is current, but it
+        may still fail to load (e.g. if it is corrupt) - in which case the DB is re-opened read-write so that
+        the jukebox can be re-created. Returns (meta_db, ids) '''
+    if meta_db.read_only:
+        try:
+            return (meta_db, jukebox.update_jukebox(mus, app_config, meta_db, jukebox_path, paths, tracks))
+        except sqlite3.OperationalError as e:
+            _LOGGER.warning('Jukebox could not be used, re-creating - %s' % str(e))
+            meta_db.close()
+            meta_db = metadata_db.MetadataDb(app_config)
+    return (meta_db, jukebox.update_jukebox(mus, app_config, meta_db, jukebox_path, paths, tracks))
+
+
+class Generation(object):
+    ''' Everything loaded from the DB, jukebox, etc. that is used to serve requests. A new generation is
+        created when the server is asked to reload, requests that started before this keep using the
+        generation they leased - which is only closed once these have finished. '''
+    def __init__(self, number, mus, app_config, jukebox_path, neighbours_path):
+        self.number = number
+        start_time = time.monotonic()
+        self.mus = mus
+        self.leases = 0
+        self.retired = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.low_memory = app_config['lowmemory']
+        self.footprint = footprint.Footprint()
+
+        meta_db = open_db(app_config, jukebox_path)
+        (paths, tracks) = features.load_tracks(mus, app_config, meta_db)
+        self.footprint.measure('features')
+
+        # Load musly from jukebox, adding any new tracks
+        (meta_db, ids) = load_jukebox(mus, app_config, meta_db, jukebox_path, paths, tracks)
+        if ids is None:
+            meta_db.close()
+            raise Exception('Failed to load jukebox')
+        self.footprint.measure('jukebox')
+        if self.low_memory:
+            paths = path_index.PackedPaths(paths)
+            self.footprint.measure('paths')
+
+        self.metadata = metadata_store.MetadataStore(meta_db, len(paths))
+        self.footprint.measure('metadata')
+        self.neighbours = neighbours.load_graph(neighbours_path, paths, meta_db.get_setting('styleid'))
+        self.clusters = clusters.load_index(app_config, mus, tracks, clusters.get_checksum(meta_db, paths)) if self.neighbours is None else None
+        self.cluster_probes = app_config['clusterprobes']
+        meta_db.close()
+        self.footprint.measure('neighbours')
+        self.mta = musly.MuslyTracksAdded(paths, tracks, ids)
+        self.path_index = path_index.PathIndex(paths, app_config['paths']['lms'])
+        self.footprint.measure('pathindex')
+        self.sim_cache = simcache.SimilarityCache(app_config['simcachesize'])
+        self.mix_cache = mixcache.MixCache(app_config['mixcachesize'], app_config['mixcachettl'])
+        self.jukeboxes = musly.JukeboxPool(mus, jukebox_path, app_config['jukeboxes'], len(paths))
+        self.sim_pool = musly.SimilarityPool(self.jukeboxes, app_config['simthreads']) if app_config['simthreads']>1 else None
+        self.footprint.measure('jukeboxpool')
+        self.num_guesses = app_config['guessneighbors'] if self.neighbours is None and len(paths)>0 else 0
+        self.guesses = 0
+        if self.num_guesses>0 and self.jukeboxes.guess_neighbors(0, 1) is None:
+            _LOGGER.warning('Musly cannot guess neighbours with this jukebox, similarities will be calculated for all tracks')
+            metrics.GUESSES.inc('unsupported')
+            self.num_guesses = 0
+        self.engine = None
+        if app_config['simengine']=='numpy':
+            try:
+                self.engine = timbre.TimbreEngine(mus, tracks)
+            except ValueError as e:
+                _LOGGER.error('Failed to create NumPy similarity engine, using Musly - %s' % str(e))
+        self.batcher = batcher.SimilarityBatcher(self.calc_all_similars, app_config['batchwindow']/1000.0)
+        self.footprint.measure('other')
+        self.footprint.log()
+        self.load_time = time.monotonic()-start_time
+        _LOGGER.debug('Generation %d loaded, %d tracks, in %.3fs' % (number, len(paths), self.load_time))
+
+
+    def acquire(self):
+        with self.lock:
+            self.leases += 1
+
+
+    def release(self):
+        with self.lock:
+            self.leases -= 1
+            close = self.retired and self.leases==0
+        if close:
+            self.close()
+
+
+    def retire(self):
+        ''' Mark as no longer current, closing now if not in use '''
+        with self.lock:
+            self.retired = True
+            close = self.leases==0
+        if close:
+            self.close()
+
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        stats = self.batcher.stats()
+        _LOGGER.debug('Closing generation %d, %d requests calculated in %d batches (max %d seeds, total delay %.3fs)' % (self.number, stats['requests'], stats['batches'], stats['maxbatch'], stats['delay']))
+        if self.sim_pool is not None:
+            self.sim_pool.shutdown()
+        self.jukeboxes.shutdown()
+        self.sim_cache.clear()
+        self.mix_cache.clear()
+        self.mus.jukebox_off()
+
+
+    def calc_similars(self, track_id):
+        simtracks = self.sim_cache.get(track_id)
+        if simtracks is None:
+            simtracks = self.batcher.get_similars([track_id])[0]
+        return simtracks
+
+
+    def calc_full_similars(self, track_id):
+        ''' Similarities of track_id to all tracks, without checking the cache - which may hold only candidates.
+            The result replaces any cached candidates. '''
+        return self.batcher.get_similars([track_id])[0]
+
+
+    def get_similars(self, track_id):
+        return self.get_all_similars([track_id])[0]
+
+
+    def calc_candidate_similars(self, track_id, ids, calc_all):
+        ''' Similarities of track_id to only the candidate tracks in ids - calc_all is called if more tracks are required '''
+        sims = self.jukeboxes.get_similars_of(self.mta.mtracks, track_id, ids)
+        if sims is None:
+            return calc_all()
+        order = numpy.lexsort((ids, sims))
+        return neighbours.NeighbourTracks(ids[order], sims[order], len(self.mta.paths), calc_all)
+
+
+    def calc_cluster_similars(self, track_id):
+        ''' Similarities of track_id to only the tracks in the nearest clusters '''
+        ids = self.clusters.get_candidates(track_id, self.cluster_probes)
+        return self.calc_candidate_similars(track_id, ids, functools.partial(self.calc_full_similars, track_id))
+
+
+    def calc_guess_fallback(self, track_id):
+        metrics.GUESSES.inc('fallback')
+        return self.calc_full_similars(track_id)
+
+
+    def check_guess_recall(self, track_id, ids):
+        ''' Count how many of track_id's most similar tracks were guessed. Called in a background thread, with
+            the generation leased. '''
+        try:
+            simtracks = self.calc_full_similars(track_id)
+            if simtracks is not None:
+                expected = simtracks.get(0, len(ids))[0]
+                metrics.GUESS_RECALL.inc('expected', amount=len(expected))
+                metrics.GUESS_RECALL.inc('found', amount=len(numpy.intersect1d(expected, ids)))
+        finally:
+            self.release()
+
+
+    def calc_guessed_similars(self, track_id):
+        ''' Similarities of track_id to only the tracks musly guesses are its neighbours '''
+        ids = self.jukeboxes.guess_neighbors(track_id, self.num_guesses)
+        if ids is None or len(ids)==0:
+            metrics.GUESSES.inc('failed')
+            return self.calc_full_similars(track_id)
+        metrics.GUESSES.inc('guessed')
+        # Seed is always first in the full list of similarities, so keep it in the list of guesses
+        ids = numpy.union1d(ids, [track_id])
+        with self.lock:
+            self.guesses += 1
+            check = self.guesses%GUESS_RECALL_INTERVAL==0
+        if check:
+            # Calculating all similarities is what guessing avoids, so this is not done whilst handling the request
+            self.acquire()
+            threading.Thread(target=self.check_guess_recall, args=(track_id, ids), name='guessrecall', daemon=True).start()
+        return self.calc_candidate_similars(track_id, ids, functools.partial(self.calc_guess_fallback, track_id))
+
+
+    def get_candidate_similars(self, track_id, calc):
+        ''' Cached similarities of track_id, else those calculated by calc - which may be of only candidate tracks '''
+        simtracks = self.sim_cache.get(track_id)
+        if simtracks is None:
+            simtracks = calc(track_id)
+            self.sim_cache.put(track_id, simtracks)
+        return simtracks
+
+
+    def get_all_similars(self, track_ids):
+        ''' Get SimilarTracks for each of track_ids. If there is a neighbour graph then tracks are read from
+            this, if musly can guess neighbours then only these are used, if there is a cluster index then only
+            tracks in the nearest clusters are used, otherwise those not in the cache are calculated - batched
+            with those of concurrent requests. '''
+        if self.neighbours is not None:
+            return [self.neighbours.get_tracks(track_id, functools.partial(self.calc_similars, track_id)) for track_id in track_ids]
+        if self.num_guesses>0:
+            return [self.get_candidate_similars(track_id, self.calc_guessed_similars) for track_id in track_ids]
+        if self.clusters is not None:
+            return [self.get_candidate_similars(track_id, self.calc_cluster_similars) for track_id in track_ids]
+        rows = {}
+        for track_id in track_ids:
+            if track_id not in rows:
+                rows[track_id] = self.sim_cache.get(track_id)
+        missing = [track_id for track_id in rows if rows[track_id] is None]
+        if len(missing)>0:
+            for track_id, simtracks in zip(missing, self.batcher.get_similars(missing)):
+                rows[track_id] = simtracks
+        return [rows[track_id] for track_id in track_ids]
+
+
+    def calc_all_similars(self, track_ids):
+        ''' Calculate SimilarTracks for each of track_ids, concurrently (or as one NumPy batch) if there are several '''
+        if self.engine is not None:
+            all_simtracks = self.engine.get_similars(track_ids)
+        elif len(track_ids)>1 and self.sim_pool is not None:
+            all_simtracks = self.sim_pool.get_similars(self.mta.mtracks, self.mta.mtrackids, track_ids)
+        else:
+            all_simtracks = [self.jukeboxes.get_similars(self.mta.mtracks, self.mta.mtrackids, track_id) for track_id in track_ids]
+        if self.low_memory:
+            all_simtracks = [None if simtracks is None else simtracks.compact() for simtracks in all_simtracks]
+        for track_id, simtracks in zip(track_ids, all_simtracks):
+            self.sim_cache.put(track_id, simtracks)
+        return all_simtracks
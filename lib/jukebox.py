@@ -0,0 +1,106 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import ctypes
+import logging
+import os
+from . import features
+
+_LOGGER = logging.getLogger(__name__)
+
+# Settings stored in DB, used to tell which tracks the jukebox holds and how much these have changed since the
+# music style was set
+PATHS_SETTING = 'jukeboxpaths'
+STYLE_TRACKS_SETTING = 'styletrackcount'
+STYLE_CHANGES_SETTING = 'stylechanges'
+
+
+def get_int_setting(meta_db, key):
+    value = meta_db.get_setting(key)
+    return 0 if value is None else int(value)
+
+
+def needs_restyle(config, meta_db, changes, num_tracks):
+    ''' Check if the number of tracks added, or removed, since the style was set exceeds restylethreshold '''
+    if config['restylethreshold']<=0:
+        return False
+    style_tracks = get_int_setting(meta_db, STYLE_TRACKS_SETTING)
+    if style_tracks<=0: # Not stored by older versions, so use current jukebox size
+        style_tracks = num_tracks
+    total_changes = get_int_setting(meta_db, STYLE_CHANGES_SETTING) + changes
+    if total_changes*100>style_tracks*config['restylethreshold']:
+        _LOGGER.info('%d tracks changed since music style was set (from %d tracks), restyling' % (total_changes, style_tracks))
+        return True
+    return False
+
+
+def is_current(meta_db, jukebox_path, paths):
+    ''' Check if jukebox file exists, and was written for paths - in which case it does not need updating '''
+    return os.path.exists(jukebox_path) and meta_db.get_setting(PATHS_SETTING)==str(features.get_checksum(paths, None))
+
+
+def update_jukebox(mus, config, meta_db, jukebox_path, paths, mtracks, old_paths=None, restyle=False):
+    ''' Load jukebox, and update so that it contains (only) the tracks in paths. old_paths should contain the
+        paths of tracks in the DB before these were changed, if not set then tracks are assumed to have been
+        appended. Tracks whose ID has changed are removed and re-added, and new tracks added, keeping the
+        jukebox's music style - unless restyle is set, or too many tracks have changed. Returns track IDs. '''
+    ids = None
+    if not restyle and os.path.exists(jukebox_path):
+        ids = mus.get_jukebox_from_file(jukebox_path)
+
+    if ids is not None:
+        if old_paths is None:
+            old_paths = paths[:len(ids)]
+        stored = meta_db.get_setting(PATHS_SETTING)
+        if len(old_paths)!=len(ids):
+            ids = None
+        elif stored is None:
+            # Jukebox was written by an older version, so can only tell if it matches if the counts are the same
+            if len(ids)!=len(paths):
+                ids = None
+        elif int(stored)!=features.get_checksum(old_paths, None):
+            ids = None
+
+    if ids is not None:
+        # Track IDs are their index, so all tracks after the first that differs need to be (re)added
+        first = 0
+        while first<len(old_paths) and first<len(paths) and old_paths[first]==paths[first]:
+            first += 1
+        removed = len(old_paths)-first
+        added = len(paths)-first
+        if removed==0 and added==0:
+            if meta_db.get_setting(PATHS_SETTING) is None:
+                meta_db.set_setting(PATHS_SETTING, str(features.get_checksum(paths, None)))
+            return ids
+        # Only count tracks that are really new, or have really been removed, towards style drift
+        old_set = set(old_paths[first:])
+        new_set = set(paths[first:])
+        changes = len(old_set-new_set) + len(new_set-old_set)
+        if not needs_restyle(config, meta_db, changes, len(old_paths)):
+            _LOGGER.debug('Updating jukebox, removing %d and adding %d tracks' % (removed, added))
+            if (removed==0 or mus.remove_tracks(list(range(first, len(old_paths))))) and (added==0 or mus.append_tracks(mtracks, first)):
+                meta_db.set_setting(STYLE_CHANGES_SETTING, str(get_int_setting(meta_db, STYLE_CHANGES_SETTING)+changes))
+                write_jukebox(mus, meta_db, jukebox_path, paths)
+                return (ctypes.c_int * len(paths))(*range(len(paths)))
+            _LOGGER.error('Failed to update jukebox, re-creating')
+
+    _LOGGER.debug('Adding tracks from DB to musly')
+    # Jukebox might have been loaded, but could not be updated - so start again with an empty jukebox
+    mus.jukebox_off()
+    mus.jukebox_on()
+    ids = mus.add_tracks(mtracks, config['styletracks'], config['styletracksmethod'], meta_db)
+    if ids is None:
+        return None
+    meta_db.set_setting(STYLE_TRACKS_SETTING, str(len(paths)))
+    meta_db.set_setting(STYLE_CHANGES_SETTING, '0')
+    write_jukebox(mus, meta_db, jukebox_path, paths)
+    return ids
+
+
+def write_jukebox(mus, meta_db, jukebox_path, paths):
+    if mus.write_jukebox(jukebox_path):
+        meta_db.set_setting(PATHS_SETTING, str(features.get_checksum(paths, None)))
@@ -8,11 +8,17 @@
 import json
 import logging
 import os
+import pickle
 import sqlite3
+import urllib.request
 from . import cue, tags
 
 DB_FILE = 'musly.db'
 GENRE_SEPARATOR = ';'
+VALS_FORMAT_PICKLE = 0 # Track data is pickled, as written by older versions (fmt column is NULL)
+VALS_FORMAT_RAW = 1    # Raw track data
+MMAP_SIZE = 256*1024*1024 # Max bytes of DB to memory-map, when opened read-only
+NORMALIZED_COLUMNS = ['ntitle varchar', 'nartist varchar', 'nalbum varchar', 'nalbumartist varchar', 'artist_id integer', 'album_id integer', 'albumartist_id integer', 'genre_ids varchar']
 _LOGGER = logging.getLogger(__name__)
 
 album_rem = ['anniversary edition', 'deluxe edition', 'expanded edition', 'extended edition', 'special edition', 'deluxe', 'deluxe version', 'extended deluxe', 'super deluxe', 're-issue', 'remastered', 'mixed', 'remixed and remastered']
@@ -61,6 +67,11 @@ def normalize_title(title):
     return normalize_str(s)
 
 
+def get_normalize_options():
+    ''' Current normalisation settings - stored in DB so that we can tell when columns need to be rebuilt '''
+    return json.dumps({'album':album_rem, 'artist':artist_rem, 'title':title_rem}, sort_keys=True)
+
+
 def set_normalize_options(opts):
     if 'album' in opts and isinstance(opts['album'], list):
         global album_rem
@@ -74,8 +85,17 @@ def set_normalize_options(opts):
 
 
 class MetadataDb(object):
-    def __init__(self, config):
+    def __init__(self, config, read_only=False):
+        ''' Open DB. If read_only is set the DB is opened read-only and memory-mapped, and the tables are not
+            created or altered - so needs_update() should be checked before using. '''
         path = os.path.join(config['paths']['db'], DB_FILE)
+        self.lookup_cache = {'artists':{}, 'albums':{}, 'genres':{}}
+        self.read_only = read_only
+        if read_only:
+            self.conn = sqlite3.connect('file:%s?mode=ro' % urllib.request.pathname2url(path), uri=True)
+            self.cursor = self.conn.cursor()
+            self.cursor.execute('PRAGMA mmap_size=%d' % MMAP_SIZE)
+            return
         self.conn = sqlite3.connect(path)
         self.cursor = self.conn.cursor()
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS tracks (
@@ -87,7 +107,16 @@ class MetadataDb(object):
                     genre varchar,
                     duration integer,
                     ignore integer,
-                    vals blob NOT NULL)''')
+                    vals blob NOT NULL,
+                    ntitle varchar,
+                    nartist varchar,
+                    nalbum varchar,
+                    nalbumartist varchar,
+                    artist_id integer,
+                    album_id integer,
+                    albumartist_id integer,
+                    genre_ids varchar,
+                    fmt integer)''')
         self.cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS tracks_idx ON tracks(file)')
         # Add 'title' column - will fail if already exists (which it should, but older instances might not have it)
         try:
@@ -105,7 +134,29 @@ class MetadataDb(object):
                     genre varchar,
                     duration integer,
                     ignore integer,
-                    vals blob)''')
+                    vals blob,
+                    ntitle varchar,
+                    nartist varchar,
+                    nalbum varchar,
+                    nalbumartist varchar,
+                    artist_id integer,
+                    album_id integer,
+                    albumartist_id integer,
+                    genre_ids varchar,
+                    fmt integer)''')
+
+        # Add normalised, and track data format, columns - will fail if already exist
+        for table in ['tracks', 'tracks_tmp']:
+            for col in NORMALIZED_COLUMNS+['fmt integer']:
+                try:
+                    self.cursor.execute('ALTER TABLE %s ADD COLUMN %s default null' % (table, col))
+                except:
+                    pass
+
+        # Lookup tables for normalised artist (and album artist), album, and genre names
+        for table in ['artists', 'albums', 'genres']:
+            self.cursor.execute('CREATE TABLE IF NOT EXISTS %s (id integer PRIMARY KEY, name varchar UNIQUE NOT NULL)' % table)
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS settings (key varchar UNIQUE NOT NULL, value varchar)')
 
 
     def commit(self):
@@ -117,11 +168,22 @@ class MetadataDb(object):
         self.conn.close()
 
 
+    def get_setting(self, key):
+        self.cursor.execute('SELECT value FROM settings WHERE key=?', (key,))
+        row = self.cursor.fetchone()
+        return None if row is None else row[0]
+
+
+    def set_setting(self, key, value):
+        self.cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+        self.commit()
+
+
     def get_metadata(self, i):
         try:
-            self.cursor.execute('SELECT title, artist, album, albumartist, genre, duration, ignore FROM tracks WHERE rowid=?', (i,))
+            self.cursor.execute('SELECT ntitle, nartist, nalbum, nalbumartist, genre, duration, ignore FROM tracks WHERE rowid=?', (i,))
             row = self.cursor.fetchone()
-            meta = {'title':normalize_title(row[0]), 'artist':normalize_artist(row[1]), 'album':normalize_album(row[2]), 'albumartist':normalize_artist(row[3]), 'duration':row[5]}
+            meta = {'title':row[0], 'artist':row[1], 'album':row[2], 'albumartist':row[3], 'duration':row[5]}
             if row[4] and len(row[4])>0:
                 meta['genres']=row[4].split(GENRE_SEPARATOR)
             meta['ignore']=row[6] is not None and row[6]==1
@@ -132,8 +194,10 @@ class MetadataDb(object):
         return None
 
 
-    def set_metadata(self, track):
-        meta = tags.read_tags(track['abs'], GENRE_SEPARATOR)
+    def set_metadata(self, track, meta=None):
+        ''' Store metadata of track, reading its tags unless these have already been read (as meta) '''
+        if meta is None:
+            meta = tags.read_tags(track['abs'], GENRE_SEPARATOR)
         if meta is not None:
             if 'track' in track and 'title' in track['track']: # Tracks from CUE files
                 meta['title'] = track['track']['title']
@@ -147,6 +211,92 @@ class MetadataDb(object):
                     self.cursor.execute('UPDATE tracks SET title=?, artist=?, album=?, albumartist=?, duration=? WHERE file=?', (meta['title'], meta['artist'], meta['album'], meta['albumartist'], meta['duration'], track['db']))
                 else:
                     self.cursor.execute('UPDATE tracks SET title=?, artist=?, album=?, albumartist=?, genre=?, duration=? WHERE file=?', (meta['title'], meta['artist'], meta['album'], meta['albumartist'], GENRE_SEPARATOR.join(meta['genres']), meta['duration'], track['db']))
+            self.cursor.execute('SELECT rowid, title, artist, album, albumartist, genre FROM tracks WHERE file=?', (track['db'],))
+            row = self.cursor.fetchone()
+            if row is not None:
+                self.set_normalized(row)
+
+
+    def get_lookup_id(self, table, name):
+        ''' Get ID of name in lookup table, adding if not already present '''
+        if name is None:
+            return None
+        cache = self.lookup_cache[table]
+        if name in cache:
+            return cache[name]
+        self.cursor.execute('SELECT id FROM %s WHERE name=?' % table, (name,))
+        row = self.cursor.fetchone()
+        if row is None:
+            self.cursor.execute('INSERT INTO %s (name) VALUES (?)' % table, (name,))
+            cache[name] = self.cursor.lastrowid
+        else:
+            cache[name] = row[0]
+        return cache[name]
+
+
+    def set_normalized(self, row):
+        ''' Store normalised, and interned, metadata for row - (rowid, title, artist, album, albumartist, genre) '''
+        artist = normalize_artist(row[2])
+        album = normalize_album(row[3])
+        albumartist = normalize_artist(row[4])
+        genre_ids = None
+        if row[5] and len(row[5])>0:
+            genre_ids = GENRE_SEPARATOR.join([str(self.get_lookup_id('genres', g)) for g in row[5].split(GENRE_SEPARATOR)])
+        self.cursor.execute('UPDATE tracks SET ntitle=?, nartist=?, nalbum=?, nalbumartist=?, artist_id=?, album_id=?, albumartist_id=?, genre_ids=? WHERE rowid=?',
+                            (normalize_title(row[1]), artist, album, albumartist, self.get_lookup_id('artists', artist), self.get_lookup_id('albums', album),
+                             self.get_lookup_id('artists', albumartist), genre_ids, row[0]))
+
+
+    def needs_update(self):
+        ''' Check if tables need to be created or altered, or their contents converted '''
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        tables = set([row[0] for row in self.cursor.fetchall()])
+        if not set(['tracks', 'tracks_tmp', 'artists', 'albums', 'genres', 'settings']).issubset(tables):
+            return True
+        self.cursor.execute('PRAGMA table_info(tracks)')
+        columns = set([row[1] for row in self.cursor.fetchall()])
+        if not set([col.split(' ')[0] for col in NORMALIZED_COLUMNS+['title varchar', 'fmt integer']]).issubset(columns):
+            return True
+        if self.get_setting('normalize')!=get_normalize_options():
+            return True
+        self.cursor.execute('SELECT 1 FROM tracks WHERE fmt IS NULL OR fmt!=? LIMIT 1', (VALS_FORMAT_RAW,))
+        return self.cursor.fetchone() is not None
+
+
+    def update_normalized(self):
+        ''' (Re)build normalised columns if the normalisation settings have changed since these were last written '''
+        opts = get_normalize_options()
+        if self.get_setting('normalize')==opts:
+            return False
+        _LOGGER.info('Normalisation settings changed, updating metadata')
+        self.cursor.execute('DELETE FROM artists')
+        self.cursor.execute('DELETE FROM albums')
+        self.cursor.execute('DELETE FROM genres')
+        for table in self.lookup_cache:
+            self.lookup_cache[table] = {}
+        self.cursor.execute('SELECT rowid, title, artist, album, albumartist, genre FROM tracks')
+        for row in self.cursor.fetchall():
+            self.set_normalized(row)
+        self.set_setting('normalize', opts)
+        return True
+
+
+    def update_vals_format(self, batch_size=1000):
+        ''' Convert pickled track data to raw. This is done in batches, each of which is committed, so that an
+            interrupted conversion is resumed the next time this is called. '''
+        converted = 0
+        while True:
+            self.cursor.execute('SELECT rowid, vals FROM tracks WHERE fmt IS NULL OR fmt!=? LIMIT ?', (VALS_FORMAT_RAW, batch_size))
+            rows = self.cursor.fetchall()
+            if len(rows)==0:
+                break
+            if converted==0:
+                _LOGGER.info('Converting track data to raw format')
+            self.cursor.executemany('UPDATE tracks SET vals=?, fmt=? WHERE rowid=?', [(pickle.loads(row[1]), VALS_FORMAT_RAW, row[0]) for row in rows])
+            self.commit()
+            converted += len(rows)
+            _LOGGER.info('Converted %d tracks' % converted)
+        return converted>0
 
 
     def remove_old_tracks(self, source_path):
@@ -186,6 +336,12 @@ class MetadataDb(object):
         self.commit()
 
 
+    def get_paths(self):
+        ''' Paths of all tracks, in rowid (and so musly ID) order '''
+        self.cursor.execute('SELECT file FROM tracks ORDER BY rowid')
+        return [row[0] for row in self.cursor.fetchall()]
+
+
     def file_already_analysed(self, path):
         self.cursor.execute('SELECT vals FROM tracks WHERE file=?', (path,))
         return self.cursor.fetchone() is not None
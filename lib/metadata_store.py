@@ -0,0 +1,142 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging
+import numpy
+from . import metadata_db
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def read_lookup(cursor, table):
+    names = {}
+    cursor.execute('SELECT id, name FROM %s' % table)
+    for row in cursor:
+        names[row[0]] = row[1]
+    return names
+
+
+class MetadataStore(object):
+    ''' In-memory copy of the normalised metadata, indexed by musly ID. Artists, albums, and genres use
+        the IDs from the DB's lookup tables, titles are interned here. -1 is used for None. '''
+    def __init__(self, meta_db, num_tracks):
+        self.num_tracks = num_tracks
+        cursor = meta_db.get_cursor()
+        self.artist_names = read_lookup(cursor, 'artists')
+        self.album_names = read_lookup(cursor, 'albums')
+        self.genre_names = read_lookup(cursor, 'genres')
+        self.artist_ids = {v: k for k, v in self.artist_names.items()}
+        self.album_ids = {v: k for k, v in self.album_names.items()}
+        self.genre_lookup = {v: k for k, v in self.genre_names.items()}
+        self.titles_list = []
+        self.title_ids = {}
+        self.valid = numpy.zeros(num_tracks, dtype=numpy.bool_)
+        self.titles = numpy.full(num_tracks, -1, dtype=numpy.int32)
+        self.artists = numpy.full(num_tracks, -1, dtype=numpy.int32)
+        self.albums = numpy.full(num_tracks, -1, dtype=numpy.int32)
+        self.albumartists = numpy.full(num_tracks, -1, dtype=numpy.int32)
+        self.durations = numpy.zeros(num_tracks, dtype=numpy.int32)
+        self.ignore = numpy.zeros(num_tracks, dtype=numpy.bool_)
+        track_genres = [()] * num_tracks
+
+        cursor.execute('SELECT rowid, ntitle, artist_id, album_id, albumartist_id, genre_ids, duration, ignore FROM tracks')
+        for row in cursor:
+            i = row[0]-1 # IDs (rowid) in SQLite are 1.. musly is 0..
+            if i<0 or i>=num_tracks:
+                continue
+            self.valid[i] = True
+            self.titles[i] = self.title_id(row[1], True)
+            self.artists[i] = -1 if row[2] is None else row[2]
+            self.albums[i] = -1 if row[3] is None else row[3]
+            self.albumartists[i] = -1 if row[4] is None else row[4]
+            if row[5]:
+                track_genres[i] = tuple(int(g) for g in row[5].split(metadata_db.GENRE_SEPARATOR))
+            if row[6] is not None and row[6]>0:
+                self.durations[i] = row[6]
+            self.ignore[i] = row[7] is not None and row[7]==1
+
+        # Genres are stored as a flat list of genre IDs, with offsets into this per track
+        self.genre_offsets = numpy.zeros(num_tracks+1, dtype=numpy.int32)
+        numpy.cumsum([len(g) for g in track_genres], out=self.genre_offsets[1:])
+        self.genre_ids = numpy.fromiter((g for genres in track_genres for g in genres), dtype=numpy.int32, count=int(self.genre_offsets[-1]))
+        self.first_genres = numpy.array([g[0] if len(g)>0 else -1 for g in track_genres], dtype=numpy.int32)
+        self.genre_mask_size = max(self.genre_names.keys(), default=0)+1
+        _LOGGER.debug('Loaded metadata for %d tracks (%d artists, %d albums, %d genres)' % (numpy.count_nonzero(self.valid), len(self.artist_names), len(self.album_names), len(self.genre_names)))
+
+
+    def title_id(self, title, add=False):
+        ''' Get ID of a (normalised) title, -1 if None or unknown '''
+        if title is None:
+            return -1
+        tid = self.title_ids.get(title, -1)
+        if tid<0 and add:
+            tid = len(self.titles_list)
+            self.titles_list.append(title)
+            self.title_ids[title] = tid
+        return tid
+
+
+    def artist_id(self, artist):
+        return -1 if artist is None else self.artist_ids.get(artist, -1)
+
+
+    def artist_ids_of(self, artists):
+        ''' IDs of artists that are known '''
+        return [self.artist_ids[a] for a in artists if a in self.artist_ids]
+
+
+    def genre_id(self, genre):
+        return self.genre_lookup.get(genre, -1)
+
+
+    def get_genre_mask(self, genres):
+        ''' Get boolean array, indexed by genre ID, that is True for each of genres '''
+        mask = numpy.zeros(self.genre_mask_size, dtype=numpy.bool_)
+        for genre in genres:
+            gid = self.genre_id(genre)
+            if gid>=0:
+                mask[gid] = True
+        return mask
+
+
+    def has_genre(self, ids, genre_mask):
+        ''' For each track in ids, check if any of its genres are set in genre_mask '''
+        starts = self.genre_offsets[ids]
+        lens = self.genre_offsets[ids+1]-starts
+        ends = numpy.cumsum(lens)
+        total = int(ends[-1]) if len(ends)>0 else 0
+        if total==0:
+            return numpy.zeros(len(ids), dtype=numpy.bool_)
+        # Index of each genre entry of each track, flattened
+        flat = numpy.repeat(starts-(ends-lens), lens) + numpy.arange(total)
+        hits = numpy.concatenate(([0], numpy.cumsum(genre_mask[self.genre_ids[flat]])))
+        return hits[ends]>hits[ends-lens]
+
+
+    def album_keys(self, ids):
+        ''' Album and album artist as a single value, for comparing albums '''
+        return ((self.albums[ids].astype(numpy.int64)+1)<<32) | (self.albumartists[ids].astype(numpy.int64)+1)
+
+
+    def get_genre_ids(self, i):
+        return self.genre_ids[self.genre_offsets[i]:self.genre_offsets[i+1]]
+
+
+    def get_metadata(self, i):
+        ''' Get metadata of a track, as a dict in the same form as MetadataDb.get_metadata '''
+        if i<0 or i>=self.num_tracks or not self.valid[i]:
+            return None
+        meta = {'title':None if self.titles[i]<0 else self.titles_list[self.titles[i]],
+                'artist':self.artist_names.get(int(self.artists[i])),
+                'album':self.album_names.get(int(self.albums[i])),
+                'albumartist':self.artist_names.get(int(self.albumartists[i])),
+                'duration':int(self.durations[i])}
+        genres = self.get_genre_ids(i)
+        if len(genres)>0:
+            meta['genres'] = [self.genre_names[g] for g in genres]
+        meta['ignore'] = bool(self.ignore[i])
+        return meta
@@ -0,0 +1,154 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import bisect
+import threading
+import time
+
+# Bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if len(pairs)>0 else ''
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    ''' Counter, or gauge, with optional labels. Label values are passed positionally, in the order of
+        the names given when created. '''
+    def __init__(self, name, help_text, kind, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help_text))
+        lines.append('# TYPE %s %s' % (self.name, self.kind))
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, format_labels(self.labels, labels), format_value(value)))
+
+
+class Histogram(object):
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = {} # labels -> [bucket counts, sum, count]
+
+
+    def observe(self, value, *labels):
+        pos = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self.values[labels] = entry
+            if pos<len(self.buckets):
+                entry[0][pos] += 1
+            entry[1] += value
+            entry[2] += 1
+
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help_text))
+        lines.append('# TYPE %s histogram' % self.name)
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, labels, 'le="%s"' % repr(bound)), cumulative))
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, labels, 'le="+Inf"'), count))
+                lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, labels), repr(total)))
+                lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, labels), count))
+
+
+class StageTimer(object):
+    ''' Time the stages of a request, passing each to the request's trace as well '''
+    def __init__(self, endpoint, tr):
+        self.endpoint = endpoint
+        self.tr = tr
+        self.last = time.monotonic()
+
+
+    def stage(self, name):
+        now = time.monotonic()
+        STAGE_SECONDS.observe(now-self.last, self.endpoint, name)
+        self.last = now
+        self.tr.stage(name)
+
+
+REQUESTS = Metric('musly_requests_total', 'Requests handled.', 'counter', ('endpoint', 'status'))
+REQUEST_SECONDS = Histogram('musly_request_duration_seconds', 'Time taken to handle requests.', ('endpoint',))
+STAGE_SECONDS = Histogram('musly_stage_duration_seconds', 'Time taken by each stage of handling a request.', ('endpoint', 'stage'))
+SIMILARITY_SECONDS = Histogram('musly_similarity_duration_seconds', 'Time taken by libmusly to calculate the similarities of a seed track.')
+CANDIDATES = Metric('musly_candidates_total', 'Candidate tracks checked, and accepted, when creating mixes.', 'counter', ('result',))
+CACHE_REQUESTS = Metric('musly_cache_requests_total', 'Similarity cache lookups.', 'counter', ('result',))
+CACHE_BYTES = Metric('musly_cache_bytes', 'Memory used by the similarity cache.', 'gauge')
+MIX_CACHE_REQUESTS = Metric('musly_mix_cache_requests_total', 'Mix candidate cache lookups.', 'counter', ('result',))
+MIX_CACHE_ENTRIES = Metric('musly_mix_cache_entries', 'Number of mixes in the mix candidate cache.', 'gauge')
+JUKEBOX_LEASES = Metric('musly_jukebox_leases_total', 'Jukebox leases, and those that had to wait for a jukebox.', 'counter', ('result',))
+JUKEBOX_WAIT_SECONDS = Metric('musly_jukebox_wait_seconds_total', 'Time spent waiting for a jukebox.', 'counter')
+JUKEBOX_POOL_SIZE = Metric('musly_jukebox_pool_size', 'Number of jukeboxes in the pool.', 'gauge')
+BATCHES = Metric('musly_batches_total', 'Batches of seed tracks calculated, the requests, and seeds, in these.', 'counter', ('item',))
+BATCH_DELAY_SECONDS = Metric('musly_batch_delay_seconds_total', 'Time requests spent waiting for batches to start.', 'counter')
+GUESS_SECONDS = Histogram('musly_guess_duration_seconds', 'Time taken by libmusly to guess the neighbours of a seed track.')
+GUESSES = Metric('musly_guesses_total', 'Seed tracks whose neighbours were guessed, and those that then needed all similarities calculated.', 'counter', ('result',))
+GUESS_RECALL = Metric('musly_guess_recall_tracks_total', 'Most similar tracks of sampled seeds, and how many of these were guessed.', 'counter', ('result',))
+GENERATION = Metric('musly_generation', 'Number of the current generation, i.e. how many times data has been loaded.', 'gauge')
+GENERATION_TRACKS = Metric('musly_generation_tracks', 'Number of tracks in the current generation.', 'gauge')
+MEMORY_BYTES = Metric('musly_memory_bytes', 'Increase in resident memory whilst loading each component of the current generation.', 'gauge', ('component',))
+GENERATION_LOAD_SECONDS = Metric('musly_generation_load_seconds', 'Time taken to load the current generation.', 'gauge')
+
+ALL_METRICS = [REQUESTS, REQUEST_SECONDS, STAGE_SECONDS, SIMILARITY_SECONDS, CANDIDATES, CACHE_REQUESTS, CACHE_BYTES, MIX_CACHE_REQUESTS,
+               MIX_CACHE_ENTRIES, JUKEBOX_LEASES, JUKEBOX_WAIT_SECONDS, JUKEBOX_POOL_SIZE, BATCHES, BATCH_DELAY_SECONDS, GUESS_SECONDS, GUESSES, GUESS_RECALL, GENERATION,
+               GENERATION_TRACKS, GENERATION_LOAD_SECONDS, MEMORY_BYTES]
+
+
+def update_generation(gen):
+    ''' Set gauges that are read from the current generation's components. Counters are incremented as
+        events happen, so that these are not reset when reloading. '''
+    CACHE_BYTES.set(gen.sim_cache.stats()['bytes'])
+    MIX_CACHE_ENTRIES.set(gen.mix_cache.stats()['entries'])
+    JUKEBOX_POOL_SIZE.set(gen.jukeboxes.stats()['size'])
+    GENERATION.set(gen.number)
+    GENERATION_TRACKS.set(len(gen.mta.paths))
+    GENERATION_LOAD_SECONDS.set(gen.load_time)
+    for (name, size) in gen.footprint.components:
+        MEMORY_BYTES.set(size, name)
+
+
+def render():
+    ''' Prometheus text format '''
+    lines = []
+    for metric in ALL_METRICS:
+        metric.render(lines)
+    return '\n'.join(lines)+'\n'
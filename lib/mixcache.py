@@ -0,0 +1,86 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from . import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def get_key(seeds, previous, params):
+    ''' Canonical hash of the inputs that determine a mix's candidates - seed and previous musly IDs
+        (in order), and the filter parameters '''
+    return hashlib.sha1(repr((tuple(seeds), tuple(previous), tuple(params))).encode()).digest()
+
+
+class MixCandidates(object):
+    ''' Filtered candidates of a mix, before any random choices are made. Tracks are (id, similarity) tuples,
+        and 'matched' is a list of (position in similar, tracks) for artists with more than 1 track to choose from. '''
+    def __init__(self, similar, matched, by_previous, by_current, by_seeds):
+        self.similar = similar
+        self.matched = matched
+        self.by_previous = by_previous
+        self.by_current = by_current
+        self.by_seeds = by_seeds
+
+
+class MixCache(object):
+    ''' LRU cache of mix candidates, keyed on the hash from get_key. Entries expire after ttl seconds, and
+        at most max_entries are kept. '''
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def enabled(self):
+        return self.max_entries>0 and self.ttl>0
+
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0]<=time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                metrics.MIX_CACHE_REQUESTS.inc('miss')
+                return None
+            self.hits += 1
+            metrics.MIX_CACHE_REQUESTS.inc('hit')
+            self.entries.move_to_end(key)
+            return entry[1]
+
+
+    def put(self, key, candidates):
+        if not self.enabled():
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic()+self.ttl, candidates)
+            self.entries.move_to_end(key)
+            while len(self.entries)>self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+    def stats(self):
+        with self.lock:
+            return {'entries':len(self.entries), 'max_entries':self.max_entries, 'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions}
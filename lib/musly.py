@@ -4,12 +4,13 @@ Musly - access libmusly functions
 (c) 2020 Caig Drummond - modified for use in musly-server
 '''
 
-import ctypes, math, random, pickle, sqlite3, logging
+import contextlib, ctypes, math, random, pickle, queue, sqlite3, logging, threading, time, uuid
+import numpy
 from collections import namedtuple
 from sys import version_info
 from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process, Pipe
-from . import metadata_db
+from . import metadata_db, metrics
 
 if version_info < (3, 2):
     exit('Python 3 required')
@@ -23,6 +24,66 @@ MUSLY_METHOD = b"timbre"
 MuslyTracksAdded = namedtuple("MuslyTracksAdded", "paths mtracks mtrackids")
 
 
+class SimilarTracks(object):
+    ''' Similarities of all tracks to a seed track. Tracks are only sorted as far as has been
+        requested, the first N are found via a partial selection and then only these are sorted.
+        Ties are ordered by track ID, and tracks with a NaN similarity are returned last. '''
+    def __init__(self, sims, buf=None, order_type=numpy.intp):
+        self.buf = buf # ctypes buffer 'sims' is a view of, must be kept alive
+        self.sims = sims
+        self.order = numpy.empty(0, dtype=order_type)
+
+
+    def __len__(self):
+        return len(self.sims)
+
+
+    def sort(self, end):
+        numtracks = len(self.sims)
+        if end>=numtracks:
+            order = numpy.argsort(self.sims, kind='stable')
+        else:
+            kth = numpy.partition(self.sims, end-1)[end-1]
+            if math.isnan(kth):
+                candidates = numpy.arange(numtracks)
+            else:
+                # Take all tracks with similarity <= kth, so that ties are not split arbitrarily
+                candidates = numpy.flatnonzero(self.sims<=kth)
+            order = candidates[numpy.argsort(self.sims[candidates], kind='stable')]
+        # May be shared between threads, so only ever replace with a longer order
+        if len(order)>len(self.order):
+            self.order = order.astype(self.order.dtype, copy=False)
+        return order
+
+
+    def get(self, start, end):
+        ''' Get IDs and similarities of tracks start..end (most similar first) '''
+        order = self.order
+        if end>len(order) and len(order)<len(self.sims):
+            order = self.sort(max(end, len(order)*2))
+        ids = order[start:end].astype(numpy.intp, copy=False)
+        return (ids, self.sims[ids].astype(numpy.float32, copy=False))
+
+
+    def compact(self):
+        ''' Copy that stores similarities as float16, and the sorted order as int32 - used to reduce memory '''
+        return SimilarTracks(self.sims.astype(numpy.float16), None, numpy.int32)
+
+
+    def nbytes(self):
+        return self.sims.nbytes + self.order.nbytes
+
+
+    def iterate(self, chunk_size):
+        ''' Iterate over (id, similarity) - sorting chunk_size tracks at a time '''
+        start = 0
+        while start<len(self.sims):
+            (ids, sims) = self.get(start, start+chunk_size)
+            for i in range(len(ids)):
+                yield (int(ids[i]), float(sims[i]))
+            start += chunk_size
+
+
 class MuslyJukebox(ctypes.Structure):
     _fields_ = [("method", ctypes.c_void_p),
                 ("method_name", ctypes.c_char_p),
@@ -35,7 +96,8 @@ class MuslyJukebox(ctypes.Structure):
 def analyze_audiofile(pipe, libmusly, index, db_path, abs_path, extract_len, extract_start):
     musly = Musly(libmusly, True)
     result = musly.analyze_file(index, -1, db_path, abs_path, extract_len, extract_start)
-    pipe.send({'ok':result['ok'], 'index':result['index'], 'track':pickle.dumps(bytes(result['mtrack']), protocol=4)})
+    # Send raw track data, or nothing if analysis failed
+    pipe.send_bytes(bytes(result['mtrack']) if result['ok'] else b'')
     pipe.close()
 
 
@@ -66,6 +128,12 @@ class Musly(object):
         self.mus.musly_track_frombin.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.c_char_p, ctypes.POINTER(ctypes.c_float)]
         # int musly_jukebox_binsize (musly_jukebox *  jukebox, int  header, int  num_tracks
         self.mus.musly_jukebox_binsize.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.c_int, ctypes.c_int ]
+        # int musly_jukebox_tobin (musly_jukebox *  jukebox, unsigned char *  buffer, int  header, int  num_tracks, int  skip_tracks
+        self.mus.musly_jukebox_tobin.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_int ]
+        # int musly_jukebox_guessneighbors (musly_jukebox *  jukebox, musly_trackid  seed, musly_trackid *  neighbors, int  num_neighbors
+        self.mus.musly_jukebox_guessneighbors.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.c_int ]
+        # int musly_jukebox_guessneighbors_filtered (musly_jukebox *  jukebox, musly_trackid  seed, musly_trackid *  neighbors, int  num_neighbors, musly_trackid *  limit_to, int  num_limit_to
+        self.mus.musly_jukebox_guessneighbors_filtered.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.c_int ]
         #int musly_jukebox_tofile (musly_jukebox * jukebox, const char *  filename)
         self.mus.musly_jukebox_tofile.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.c_char_p ]
         # musly_jukebox* musly_jukebox_fromfile (const char *  filename)
@@ -88,11 +156,29 @@ class Musly(object):
         self.mtrackbinsize = self.mus.musly_track_binsize(self.mj)
         self.mtracksize = self.mus.musly_track_size(self.mj)
         self.mtrack_type = ctypes.c_float * math.ceil(self.mtracksize/ctypes.sizeof(ctypes.c_float()))
-        
+
+        # Arrays of tracks, IDs, and similarities are passed as pointers to their first element - so that these
+        # argtypes do not depend upon the number of tracks, and can be shared by concurrent calls
+        mtracks_ptr = ctypes.POINTER(ctypes.POINTER(self.mtrack_type))
+        # int musly_jukebox_gettrackids (musly_jukebox *  jukebox,musly_trackid *  trackids)
+        self.mus.musly_jukebox_gettrackids.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.POINTER(ctypes.c_int)]
+        # int musly_jukebox_setmusicstyle (musly_jukebox * jukebox, musly_track **  tracks, int  num_tracks
+        self.mus.musly_jukebox_setmusicstyle.argtypes = [ctypes.POINTER(MuslyJukebox), mtracks_ptr, ctypes.c_int ]
+        #int musly_jukebox_addtracks (musly_jukebox *  jukebox, musly_track **  tracks, musly_trackid *  trackids, int  num_tracks, int  generate_ids
+        self.mus.musly_jukebox_addtracks.argtypes = [ctypes.POINTER(MuslyJukebox), mtracks_ptr, ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_int]
+        # int musly_jukebox_removetracks (musly_jukebox *  jukebox, musly_trackid *  trackids, int  num_tracks
+        self.mus.musly_jukebox_removetracks.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.POINTER(ctypes.c_int), ctypes.c_int]
+        # int musly_jukebox_similarity (musly_jukebox *  jukebox, musly_track *  seed_track, musly_trackid  seed_trackid, musly_track **  tracks, musly_trackid *  trackids, int  num_tracks, float *  similarities 
+        self.mus.musly_jukebox_similarity.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.POINTER(ctypes.c_float), ctypes.c_int, mtracks_ptr, ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.POINTER(ctypes.c_float) ]
+
         if not quiet:
             _LOGGER.debug("musly init done")
 
 
+    def jukebox_on(self):
+        self.mj = self.mus.musly_jukebox_poweron(self.method, self.decoder)
+
+
     def jukebox_off(self):
         self.mus.musly_jukebox_poweroff (self.mj)
 
@@ -101,6 +187,21 @@ class Musly(object):
         return self.mus.musly_jukebox_binsize(self.mj, 1, -1)
 
 
+    def get_jukebox_bin(self, mj=None):
+        ''' Serialise jukebox, returns (header size, data) - data holds the header then the state of each track '''
+        mj = self.mj if mj is None else mj
+        header_size = self.mus.musly_jukebox_binsize(mj, 1, 0)
+        size = self.mus.musly_jukebox_binsize(mj, 1, -1)
+        if header_size<0 or size<header_size:
+            _LOGGER.error("musly_jukebox_binsize failed")
+            return None
+        buf = ctypes.create_string_buffer(size)
+        if self.mus.musly_jukebox_tobin(mj, buf, 1, -1, 0)!=size:
+            _LOGGER.error("musly_jukebox_tobin failed")
+            return None
+        return (header_size, buf.raw)
+
+
     def write_jukebox(self, path):
         _LOGGER.debug("write_jukebox: jukebox path: {}".format(path))
         if self.mus.musly_jukebox_tofile(self.mj, ctypes.c_char_p(bytes(path, 'utf-8'))) == -1:
@@ -130,9 +231,7 @@ class Musly(object):
         numtracks = self.mus.musly_jukebox_trackcount(localmj)
         mtrackids_type = ctypes.c_int * numtracks
         mtrackids = mtrackids_type()
-        #int musly_jukebox_gettrackids (musly_jukebox *  jukebox,musly_trackid *  trackids)
-        self.mus.musly_jukebox_gettrackids.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.POINTER(mtrackids_type)]
-        if self.mus.musly_jukebox_gettrackids(localmj, ctypes.pointer(mtrackids)) == -1:
+        if self.mus.musly_jukebox_gettrackids(localmj, mtrackids) == -1:
             _LOGGER.error("Failed to get track IDs from jukebox")
             return None
         self.jukebox_off()
@@ -140,41 +239,54 @@ class Musly(object):
         return mtrackids
 
 
+    def get_track_vals(self, row):
+        ''' Get track data from (vals, fmt) DB columns '''
+        return row[0] if row[1]==metadata_db.VALS_FORMAT_RAW else pickle.loads(row[0])
+
+
+    def get_mtracks(self, buf, numtracks, stride, offset=0):
+        ''' Create array of musly_track pointers into buf, which holds numtracks tracks of stride bytes from offset '''
+        mtracks = ((ctypes.POINTER(self.mtrack_type)) * numtracks)()
+        if numtracks>0:
+            addr = buf.ctypes.data + offset
+            numpy.frombuffer(mtracks, dtype=numpy.uintp)[:] = addr + (numpy.arange(numtracks, dtype=numpy.uintp) * stride)
+        # Pointers are only valid whilst buf exists
+        mtracks.buf = buf
+        mtracks.stride = stride
+        mtracks.offset = offset
+        return mtracks
+
+
     def get_track_db(self, scursor, path):
-        scursor.execute('SELECT vals FROM tracks WHERE file=?', (path,))
+        scursor.execute('SELECT vals, fmt FROM tracks WHERE file=?', (path,))
         row = scursor.fetchone()
         if (row == None):
             _LOGGER.debug("Culd not find {} in DB".format(path))
             return None
         else:
             mtrack = self.mtrack_type()
-            smt_c = ctypes.c_char_p(pickle.loads(row[0]))
-            smt_f = ctypes.cast(smt_c, ctypes.POINTER(ctypes.c_float))
-            ctypes.memmove(mtrack, smt_f, self.mtracksize)
+            vals = self.get_track_vals(row)
+            ctypes.memmove(mtrack, vals, min(len(vals), self.mtracksize))
             return mtrack
 
 
     def get_alltracks_db(self, scursor):
         scursor.execute('SELECT count(vals) FROM tracks')
         numtracks = scursor.fetchone()[0]
-        mtrack = self.mtrack_type()
-        mtracks_type = (ctypes.POINTER(self.mtrack_type)) * numtracks
-        mtracks = mtracks_type()
+        # Tracks are copied, via buffer views, into one contiguous array
+        stride = ctypes.sizeof(self.mtrack_type)
+        buf = numpy.zeros((numtracks, stride), dtype=numpy.uint8)
 
-        scursor.execute('SELECT file, vals FROM tracks')
+        scursor.execute('SELECT file, vals, fmt FROM tracks ORDER BY rowid')
         i = 0
         paths = [None] * numtracks
         for row in scursor:
-#            _LOGGER.debug("get_alltracks_db [{:4}]: {}".format(i, row[0]))
             paths[i] = row[0]
-            smt_c = ctypes.c_char_p(pickle.loads(row[1]))
-            smt_f = ctypes.cast(smt_c, ctypes.POINTER(ctypes.c_float))
-            ctypes.memmove(mtrack, smt_f, self.mtracksize)
-            mtracks[i] = ctypes.pointer(mtrack)
-            mtrack = self.mtrack_type()
+            vals = numpy.frombuffer(self.get_track_vals(row[1:]), dtype=numpy.uint8)[:self.mtracksize]
+            buf[i, :len(vals)] = vals
             i += 1
 
-        return (paths, mtracks)
+        return (paths, self.get_mtracks(buf, numtracks, stride))
 
 
     def analyze_file(self, index, total, db_path, abs_path, extract_len, extract_start):
@@ -193,10 +305,10 @@ class Musly(object):
         pout, pin = Pipe(duplex=False)
         p = Process(target=analyze_audiofile, args=(pin, self.libmusly, index, db_path, abs_path, extract_len, extract_start))
         p.start()
-        r = pout.recv()
+        track = pout.recv_bytes()
         p.terminate()
         p.join()
-        return r
+        return {'ok':len(track)>0, 'index':index, 'track':track}
 
 
     def analyze_files(self, meta_db, allfiles, extract_len = 60, extract_start = -48, num_threads=8):
@@ -217,10 +329,8 @@ class Musly(object):
                 try:
                     result = future.result()
                     if result['ok']:
-                        if 'mtrack' in result:
-                            meta_db.get_cursor().execute('INSERT INTO tracks (file, vals) VALUES (?, ?)', (allfiles[result['index']]['db'], pickle.dumps(bytes(result['mtrack']), protocol=4)))
-                        else:
-                            meta_db.get_cursor().execute('INSERT INTO tracks (file, vals) VALUES (?, ?)', (allfiles[result['index']]['db'], result['track']))
+                        track = bytes(result['mtrack']) if 'mtrack' in result else result['track']
+                        meta_db.get_cursor().execute('INSERT INTO tracks (file, vals, fmt) VALUES (?, ?, ?)', (allfiles[result['index']]['db'], track, metadata_db.VALS_FORMAT_RAW))
                         inserts_since_commit += 1
                         if inserts_since_commit >= 500:
                             inserts_since_commit = 0
@@ -235,7 +345,6 @@ class Musly(object):
         numtracks = len(mtracks)
         mtrackids_type = ctypes.c_int * numtracks
         mtrackids = mtrackids_type()
-        mtracks_type = (ctypes.POINTER(self.mtrack_type)) * numtracks
         _LOGGER.debug("Numtracks = {}".format(numtracks))
 
         style_tracks = []
@@ -303,45 +412,202 @@ class Musly(object):
                 i += 1
         else:
             _LOGGER.debug("Using all tracks (%d) for setmusicstyle" % (numtracks))
-            smtracks_type = mtracks_type
             smtracks = mtracks
             snumtracks = numtracks
         
-        # int musly_jukebox_setmusicstyle (musly_jukebox * jukebox, musly_track **  tracks, int  num_tracks
-        self.mus.musly_jukebox_setmusicstyle.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.POINTER(smtracks_type), ctypes.c_int ]
-        #int musly_jukebox_addtracks (musly_jukebox *  jukebox, musly_track **  tracks, musly_trackid *  trackids, int  num_tracks, int  generate_ids
-        self.mus.musly_jukebox_addtracks.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.POINTER(mtracks_type), ctypes.POINTER(mtrackids_type), ctypes.c_int, ctypes.c_int]
-
-        if (self.mus.musly_jukebox_setmusicstyle(self.mj, ctypes.pointer(smtracks), ctypes.c_int(snumtracks)) == -1) :
+        if (self.mus.musly_jukebox_setmusicstyle(self.mj, smtracks, ctypes.c_int(snumtracks)) == -1) :
             _LOGGER.error("musly_jukebox_setmusicstyle")
             return None
         else:
-            if self.mus.musly_jukebox_addtracks(self.mj, ctypes.pointer(mtracks), ctypes.pointer(mtrackids), ctypes.c_int(numtracks), ctypes.c_int(1)) == -1:
+            if self.mus.musly_jukebox_addtracks(self.mj, mtracks, mtrackids, ctypes.c_int(numtracks), ctypes.c_int(1)) == -1:
                 _LOGGER.error("musly_jukebox_addtracks")
                 return None
             
+        # Similarities depend upon the music style, so record that this has changed
+        meta_db.set_setting('styleid', uuid.uuid4().hex)
         _LOGGER.info("Added {} tracks".format(numtracks))
         return mtrackids
 
 
-    def get_similars(self, mtracks, mtrackids, seedtrackid):
-        numtracks = len(mtracks)
+    def remove_tracks(self, trackids):
+        numtracks = len(trackids)
+        mtrackids_type = ctypes.c_int * numtracks
+        mtrackids = mtrackids_type(*trackids)
+        if self.mus.musly_jukebox_removetracks(self.mj, mtrackids, ctypes.c_int(numtracks)) == -1:
+            _LOGGER.error("musly_jukebox_removetracks")
+            return False
+        _LOGGER.info("Removed {} tracks".format(numtracks))
+        return True
+
+
+    def append_tracks(self, mtracks, start):
+        ''' Add mtracks[start:] to jukebox, using the existing music style. Track IDs are their index. '''
+        numtracks = len(mtracks)-start
         mtrackids_type = ctypes.c_int * numtracks
+        mtrackids = mtrackids_type(*range(start, len(mtracks)))
         mtracks_type = (ctypes.POINTER(self.mtrack_type)) * numtracks
-        msims_type = ctypes.c_float * numtracks
-        msims = msims_type()
-        # int musly_jukebox_similarity (musly_jukebox *  jukebox, musly_track *  seed_track, musly_trackid  seed_trackid, musly_track **  tracks, musly_trackid *  trackids, int  num_tracks, float *  similarities 
-        self.mus.musly_jukebox_similarity.argtypes = [ctypes.POINTER(MuslyJukebox), ctypes.POINTER(ctypes.c_float), ctypes.c_int, ctypes.POINTER(mtracks_type), ctypes.POINTER(mtrackids_type), ctypes.c_int, ctypes.POINTER(msims_type) ]
+        new_mtracks = mtracks_type(*mtracks[start:])
+        if self.mus.musly_jukebox_addtracks(self.mj, new_mtracks, mtrackids, ctypes.c_int(numtracks), ctypes.c_int(0)) == -1:
+            _LOGGER.error("musly_jukebox_addtracks")
+            return False
+        _LOGGER.info("Added {} tracks".format(numtracks))
+        return True
 
-        seedtrack = mtracks[seedtrackid].contents
 
-        if (self.mus.musly_jukebox_similarity(self.mj, seedtrack, ctypes.c_int(seedtrackid), ctypes.pointer(mtracks), ctypes.pointer(mtrackids), ctypes.c_int(numtracks), ctypes.pointer(msims))) == -1:
+    def calc_similarities(self, seedtrack, seedtrackid, mtracks, mtrackids, mj=None):
+        ''' Similarity of seed track to each of mtracks, returned as a ctypes array of floats '''
+        numtracks = len(mtracks)
+        msims = (ctypes.c_float * numtracks)()
+        if (self.mus.musly_jukebox_similarity(self.mj if mj is None else mj, seedtrack, ctypes.c_int(seedtrackid), mtracks, mtrackids, ctypes.c_int(numtracks), msims)) == -1:
             _LOGGER.error("musly_jukebox_similarity")
             return None
+        return msims
+
+
+    def guess_neighbors(self, seedtrackid, num_neighbors, limit_to=None, mj=None):
+        ''' Ask musly to guess the num_neighbors most similar tracks to the seed, optionally only from limit_to (a
+            numpy array of IDs). Returns the IDs (in no particular order), or None if the jukebox's method
+            cannot guess neighbours. '''
+        neighbors = (ctypes.c_int * num_neighbors)()
+        if limit_to is None:
+            found = self.mus.musly_jukebox_guessneighbors(self.mj if mj is None else mj, seedtrackid, neighbors, num_neighbors)
+        else:
+            limit = (ctypes.c_int * len(limit_to))()
+            numpy.frombuffer(limit, dtype=numpy.intc)[:] = limit_to
+            found = self.mus.musly_jukebox_guessneighbors_filtered(self.mj if mj is None else mj, seedtrackid, neighbors, num_neighbors, limit, len(limit_to))
+        if found<0:
+            return None
+        return numpy.frombuffer(neighbors, dtype=numpy.intc)[:found].astype(numpy.intp)
+
+
+    def get_similars_of(self, mtracks, seedtrackid, track_ids, mj=None):
+        ''' Similarity of seed track to only the tracks in track_ids (a numpy array of IDs) '''
+        numtracks = len(track_ids)
+        subset = ((ctypes.POINTER(self.mtrack_type)) * numtracks)()
+        numpy.frombuffer(subset, dtype=numpy.uintp)[:] = numpy.frombuffer(mtracks, dtype=numpy.uintp)[track_ids]
+        subset_ids = (ctypes.c_int * numtracks)()
+        numpy.frombuffer(subset_ids, dtype=numpy.intc)[:] = track_ids
+        msims = self.calc_similarities(mtracks[seedtrackid].contents, seedtrackid, subset, subset_ids, mj)
+        return None if msims is None else numpy.ctypeslib.as_array(msims)
+
+
+    def get_similars(self, mtracks, mtrackids, seedtrackid, mj=None):
+        msims = self.calc_similarities(mtracks[seedtrackid].contents, seedtrackid, mtracks, mtrackids, mj)
+        if msims is None:
+            return None
+
+        # Tracks IDs are the same as their index, so musly's output can be used as-is
+        return SimilarTracks(numpy.ctypeslib.as_array(msims), msims)
+
+
+class JukeboxPool(object):
+    ''' Jukebox handles, loaded from file, that are leased for each similarity calculation - as libmusly
+        does not seem to be thread safe. If all handles are in use then callers wait for one to be returned.
+        All handles are loaded up-front, so that they match the tracks even if the jukebox file is later
+        re-written. '''
+    def __init__(self, mus, jukebox_path, size, num_tracks):
+        self.mus = mus
+        self.lock = threading.Lock()
+        self.jukeboxes = []
+        self.available = queue.Queue()
+        self.leases = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        for i in range(size):
+            mj = mus.read_jukebox(jukebox_path)
+            if not mj:
+                break
+            if mus.mus.musly_jukebox_trackcount(mj)!=num_tracks:
+                _LOGGER.error('Jukebox file does not match tracks')
+                mus.mus.musly_jukebox_poweroff(mj)
+                break
+            self.jukeboxes.append(mj)
+            self.available.put(mj)
+        if len(self.jukeboxes)==0:
+            # Could not load from file, so fallback to the (single) jukebox already loaded
+            self.available.put(mus.mj)
+        self.size = max(1, len(self.jukeboxes))
+        _LOGGER.debug('Using %d jukebox handles' % self.size)
+
+
+    @contextlib.contextmanager
+    def lease(self):
+        try:
+            mj = self.available.get_nowait()
+            waited = 0.0
+        except queue.Empty:
+            start = time.monotonic()
+            mj = self.available.get()
+            waited = time.monotonic()-start
+        with self.lock:
+            self.leases += 1
+            if waited>0.0:
+                self.waits += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+        metrics.JUKEBOX_LEASES.inc('leased')
+        if waited>0.0:
+            metrics.JUKEBOX_LEASES.inc('waited')
+            metrics.JUKEBOX_WAIT_SECONDS.inc(amount=waited)
+        try:
+            yield mj
+        finally:
+            self.available.put(mj)
+
+
+    def get_similars(self, mtracks, mtrackids, seedtrackid):
+        with self.lease() as mj:
+            start = time.monotonic()
+            simtracks = self.mus.get_similars(mtracks, mtrackids, seedtrackid, mj)
+            metrics.SIMILARITY_SECONDS.observe(time.monotonic()-start)
+            return simtracks
+
+
+    def guess_neighbors(self, seedtrackid, num_neighbors, limit_to=None):
+        with self.lease() as mj:
+            start = time.monotonic()
+            ids = self.mus.guess_neighbors(seedtrackid, num_neighbors, limit_to, mj)
+            metrics.GUESS_SECONDS.observe(time.monotonic()-start)
+            return ids
+
+
+    def get_similars_of(self, mtracks, seedtrackid, track_ids):
+        with self.lease() as mj:
+            start = time.monotonic()
+            sims = self.mus.get_similars_of(mtracks, seedtrackid, track_ids, mj)
+            metrics.SIMILARITY_SECONDS.observe(time.monotonic()-start)
+            return sims
+
+
+    def stats(self):
+        with self.lock:
+            return {'size':self.size, 'inuse':self.size-self.available.qsize(), 'leases':self.leases, 'waits':self.waits,
+                    'waittime':self.wait_time, 'maxwait':self.max_wait}
+
+
+    def shutdown(self):
+        stats = self.stats()
+        _LOGGER.debug('Jukebox pool: %d leases, %d waited (total %.3fs, max %.3fs)' % (stats['leases'], stats['waits'], stats['waittime'], stats['maxwait']))
+        for mj in self.jukeboxes:
+            self.mus.mus.musly_jukebox_poweroff(mj)
+        self.jukeboxes = []
+
+
+class SimilarityPool(object):
+    ''' Calculate the similarities of several seed tracks concurrently. ctypes releases the GIL whilst
+        libmusly is called, and each calculation leases its own jukebox from the pool. '''
+    def __init__(self, jukeboxes, num_threads):
+        self.jukeboxes = jukeboxes
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='similarity')
+        _LOGGER.debug('Using %d threads for similarity calculations' % num_threads)
+
+
+    def get_similars(self, mtracks, mtrackids, seedtrackids):
+        ''' Get SimilarTracks for each seed, in the same order as seedtrackids '''
+        futures_list = [self.executor.submit(self.jukeboxes.get_similars, mtracks, mtrackids, seed) for seed in seedtrackids]
+        return [future.result() for future in futures_list]
 
-        rtracks=[]
-        for i in mtrackids:
-            #_LOGGER.debug("get_similars: mtrack id: {:3} sim: {:8.6f}".format(i, msims[i]))
-            rtracks.append({'id':i, 'sim':msims[i]})
-        return sorted(rtracks, key=lambda k: k['sim'])
 
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,257 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import ctypes
+import hashlib
+import logging
+import multiprocessing
+import numpy
+import os
+import struct
+import uuid
+from . import features, jukebox, metadata_db
+
+_LOGGER = logging.getLogger(__name__)
+
+# File layout: header, padded to DATA_OFFSET, then track IDs (int32) and similarities (float32, or float16
+# to save memory) of the most similar 'width' tracks to each track, i.e. 2 arrays of num_tracks*width
+MAGIC = b'MSNG'
+VERSION = 2
+HEADER_V1 = struct.Struct('<4sIII20s32s') # magic, version, num_tracks, num_neighbours, paths hash, style ID
+HEADER = struct.Struct('<4sIII20s32sI') # As V1, plus index of similarity type in SIM_TYPES
+DATA_OFFSET = 128
+SIM_TYPES = [numpy.float32, numpy.float16]
+ROWS_PER_TASK = 64
+
+# State used by the build worker processes, set before these are forked
+_build = {}
+
+
+def paths_hash(paths):
+    ''' Hash of track paths - these are in musly ID order '''
+    sha = hashlib.sha1()
+    for path in paths:
+        sha.update(path.encode('utf-8', 'surrogateescape'))
+        sha.update(b'\n')
+    return sha.digest()
+
+
+class NeighbourTracks(object):
+    ''' Most similar tracks to a seed, in the same form as musly.SimilarTracks. Tracks are read from
+        the graph, and only if more are requested are the similarities calculated. '''
+    def __init__(self, ids, sims, num_tracks, calc_similars):
+        self.ids = ids
+        self.sims = sims
+        self.num_tracks = num_tracks
+        self.calc_similars = calc_similars
+        self.simtracks = None
+
+
+    def __len__(self):
+        return self.num_tracks
+
+
+    def nbytes(self):
+        return self.ids.nbytes + self.sims.nbytes + (0 if self.simtracks is None else self.simtracks.nbytes())
+
+
+    def get(self, start, end):
+        ''' Get IDs and similarities of tracks start..end (most similar first). If the range starts within
+            the graph, but extends past it, only the tracks in the graph are returned. '''
+        width = len(self.ids)
+        if start<width or width>=self.num_tracks:
+            end = min(end, width)
+            return (self.ids[start:end].astype(numpy.intp), self.sims[start:end].astype(numpy.float32))
+        if self.simtracks is None:
+            self.simtracks = self.calc_similars()
+            if self.simtracks is None:
+                return (numpy.empty(0, dtype=numpy.intp), numpy.empty(0, dtype=numpy.float32))
+        return self.simtracks.get(start, end)
+
+
+class NeighbourGraph(object):
+    ''' Read-only, memory-mapped, graph file '''
+    def __init__(self, path):
+        self.data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        if len(self.data)<DATA_OFFSET:
+            raise ValueError('File too small')
+        (magic, version, self.num_tracks, self.num_neighbours, self.paths_hash, styleid) = HEADER_V1.unpack(self.data[:HEADER_V1.size].tobytes())
+        if magic!=MAGIC or version not in [1, VERSION]:
+            raise ValueError('Unsupported file')
+        self.sim_type = HEADER.unpack(self.data[:HEADER.size].tobytes())[-1] if version==VERSION else 0
+        if self.sim_type>=len(SIM_TYPES):
+            raise ValueError('Unsupported similarity type')
+        self.styleid = styleid.decode('ascii')
+        self.width = min(self.num_neighbours, self.num_tracks)
+        size = self.num_tracks*self.width*4
+        sims_size = self.num_tracks*self.width*numpy.dtype(SIM_TYPES[self.sim_type]).itemsize
+        if len(self.data)!=DATA_OFFSET+size+sims_size:
+            raise ValueError('Invalid file size')
+        self.ids = self.data[DATA_OFFSET:DATA_OFFSET+size].view(numpy.int32).reshape(self.num_tracks, self.width)
+        self.sims = self.data[DATA_OFFSET+size:].view(SIM_TYPES[self.sim_type]).reshape(self.num_tracks, self.width)
+
+
+    def is_current(self, paths, styleid):
+        return self.num_tracks==len(paths) and self.styleid==styleid and self.paths_hash==paths_hash(paths)
+
+
+    def get_tracks(self, track_id, calc_similars):
+        return NeighbourTracks(self.ids[track_id], self.sims[track_id], self.num_tracks, calc_similars)
+
+
+def load_graph(path, paths, styleid):
+    ''' Load graph, if it exists and was created from the current jukebox '''
+    if not os.path.exists(path):
+        return None
+    try:
+        graph = NeighbourGraph(path)
+    except Exception as e:
+        _LOGGER.error('Failed to read %s - %s' % (path, str(e)))
+        return None
+    if not graph.is_current(paths, styleid):
+        _LOGGER.info('%s is out of date, similarities will be calculated as required' % path)
+        return None
+    _LOGGER.debug('Loaded %d neighbours of %d tracks' % (graph.width, graph.num_tracks))
+    return graph
+
+
+def calc_rows(task):
+    ''' Build worker - most similar tracks to each of start..end '''
+    (start, end) = task
+    mus = _build['mus']
+    width = _build['width']
+    ids = numpy.empty((end-start, width), dtype=numpy.int32)
+    sims = numpy.empty((end-start, width), dtype=numpy.float32)
+    for seed in range(start, end):
+        simtracks = mus.get_similars(_build['mtracks'], _build['mtrackids'], seed)
+        if simtracks is None:
+            raise Exception('Failed to get similarities for %d' % seed)
+        (ids[seed-start], sims[seed-start]) = simtracks.get(0, width)
+    return (start, ids, sims)
+
+
+def merge_rows(task):
+    ''' Build worker - merge tracks added since graph was created into the existing rows start..end '''
+    (start, end) = task
+    mus = _build['mus']
+    width = _build['width']
+    old = _build['old']
+    mtracks = _build['mtracks']
+    new_ids = numpy.arange(old.num_tracks, len(mtracks))
+    new_tracks = (ctypes.POINTER(mus.mtrack_type) * len(new_ids))(*mtracks[old.num_tracks:])
+    new_trackids = (ctypes.c_int * len(new_ids))(*_build['mtrackids'][old.num_tracks:])
+    ids = numpy.empty((end-start, width), dtype=numpy.int32)
+    sims = numpy.empty((end-start, width), dtype=numpy.float32)
+    for seed in range(start, end):
+        msims = mus.calc_similarities(mtracks[seed].contents, seed, new_tracks, new_trackids)
+        if msims is None:
+            raise Exception('Failed to get similarities for %d' % seed)
+        # Order by similarity, then ID - as musly.SimilarTracks would (NaNs are sorted last)
+        row_ids = numpy.concatenate((old.ids[seed], new_ids))
+        row_sims = numpy.concatenate((old.sims[seed].astype(numpy.float32), numpy.ctypeslib.as_array(msims)))
+        order = numpy.lexsort((row_ids, row_sims))[:width]
+        ids[seed-start] = row_ids[order]
+        sims[seed-start] = row_sims[order]
+    return (start, ids, sims)
+
+
+def run_tasks(func, start, end, ids, sims, num_processes):
+    tasks = [(s, min(s+ROWS_PER_TASK, end)) for s in range(start, end, ROWS_PER_TASK)]
+    if len(tasks)==0:
+        return
+    done = 0
+    with multiprocessing.get_context('fork').Pool(processes=num_processes) as pool:
+        for (first, row_ids, row_sims) in pool.imap_unordered(func, tasks):
+            ids[first:first+len(row_ids)] = row_ids
+            sims[first:first+len(row_sims)] = row_sims
+            done += 1
+            if done%100==0 or done==len(tasks):
+                _LOGGER.info('[%d/%d %d%%] Calculated neighbours' % (done, len(tasks), int(done*100/len(tasks))))
+
+
+def build_graph(mus, paths, mtracks, mtrackids, styleid, path, num_neighbours, num_processes, sim_type=0):
+    ''' Build graph of the num_neighbours most similar tracks of each track. If the existing graph was created
+        with the same style (and similarity type), and its tracks are the first in the jukebox, then only the
+        similarities to the tracks added since are calculated. '''
+    num_tracks = len(paths)
+    width = min(num_neighbours, num_tracks)
+    old = None
+    if os.path.exists(path):
+        try:
+            old = NeighbourGraph(path)
+        except Exception as e:
+            _LOGGER.debug('Ignoring existing graph - %s' % str(e))
+        if old is not None and old.is_current(paths, styleid) and old.num_neighbours==num_neighbours and old.sim_type==sim_type:
+            _LOGGER.info('Neighbour graph is already up to date')
+            return True
+        if old is not None and not (old.styleid==styleid and old.num_neighbours==num_neighbours and old.sim_type==sim_type and
+                                    old.num_tracks<num_tracks and old.paths_hash==paths_hash(paths[:old.num_tracks])):
+            old = None
+
+    _build.update({'mus':mus, 'mtracks':mtracks, 'mtrackids':mtrackids, 'width':width, 'old':old})
+    tmp_path = path+'.tmp'
+    try:
+        size = num_tracks*width*4
+        sims_size = num_tracks*width*numpy.dtype(SIM_TYPES[sim_type]).itemsize
+        data = numpy.memmap(tmp_path, dtype=numpy.uint8, mode='w+', shape=DATA_OFFSET+size+sims_size)
+        data[:HEADER.size] = numpy.frombuffer(HEADER.pack(MAGIC, VERSION, num_tracks, num_neighbours, paths_hash(paths), styleid.encode('ascii'), sim_type), dtype=numpy.uint8)
+        ids = data[DATA_OFFSET:DATA_OFFSET+size].view(numpy.int32).reshape(num_tracks, width)
+        sims = data[DATA_OFFSET+size:].view(SIM_TYPES[sim_type]).reshape(num_tracks, width)
+        if old is None:
+            _LOGGER.info('Calculating %d neighbours of %d tracks' % (width, num_tracks))
+            run_tasks(calc_rows, 0, num_tracks, ids, sims, num_processes)
+        else:
+            _LOGGER.info('Updating neighbours of %d tracks, with %d new tracks' % (old.num_tracks, num_tracks-old.num_tracks))
+            run_tasks(merge_rows, 0, old.num_tracks, ids, sims, num_processes)
+            run_tasks(calc_rows, old.num_tracks, num_tracks, ids, sims, num_processes)
+        data.flush()
+        del ids, sims, data
+        # Replace, rather than overwrite, so that a running server's mapping remains valid
+        os.replace(tmp_path, path)
+    except Exception as e:
+        _LOGGER.error('Failed to create neighbour graph - %s' % str(e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    finally:
+        _build.clear()
+    _LOGGER.info('Saved neighbour graph to %s' % path)
+    return True
+
+
+def get_styleid(meta_db):
+    ''' Get ID of jukebox's style - creating one if not set (jukebox created before this was stored) '''
+    styleid = meta_db.get_setting('styleid')
+    if styleid is None:
+        styleid = uuid.uuid4().hex
+        meta_db.set_setting('styleid', styleid)
+    return styleid
+
+
+def build_neighbours(mus, config, jukebox_path, path, num_neighbours):
+    ''' Build, or update, graph from the current DB and jukebox '''
+    meta_db = metadata_db.MetadataDb(config)
+    (paths, mtracks) = features.load_tracks(mus, config, meta_db)
+    mtrackids = jukebox.update_jukebox(mus, config, meta_db, jukebox_path, paths, mtracks)
+    styleid = get_styleid(meta_db)
+    meta_db.close()
+    if mtrackids is None:
+        _LOGGER.error('Failed to load jukebox')
+        return False
+    return build_graph(mus, paths, mtracks, mtrackids, styleid, path, num_neighbours, config['threads'], 1 if config['lowmemory'] else 0)
+
+
+def update_neighbours(mus, meta_db, paths, mtracks, mtrackids, path, num_processes):
+    ''' Update existing graph after analysis '''
+    if not os.path.exists(path):
+        return
+    try:
+        old = NeighbourGraph(path)
+    except Exception as e:
+        _LOGGER.error('Failed to read %s - %s' % (path, str(e)))
+        return
+    build_graph(mus, paths, mtracks, mtrackids, get_styleid(meta_db), path, old.num_neighbours, num_processes, old.sim_type)
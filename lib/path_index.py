@@ -0,0 +1,119 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging
+import numpy
+import zlib
+from urllib.parse import unquote
+from . import cue
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def decode(url, root):
+    ''' Convert a path, or URL, as sent by LMS into the path stored in the DB '''
+    u = unquote(url)
+    if u.startswith('file://'):
+        u=u[7:]
+    elif u.startswith('tmp://'):
+        u=u[6:]
+    if u.startswith(root):
+        u=u[len(root):]
+    return cue.convert_from_cue_path(u)
+
+
+def encode(path):
+    return path.encode('utf-8', 'surrogateescape')
+
+
+class PackedPaths(object):
+    ''' Track paths, in musly ID order, stored as one UTF-8 buffer with the offset of each path - rather
+        than as a list of str. Used to reduce memory. '''
+    def __init__(self, paths):
+        encoded = [encode(path) for path in paths]
+        self.offsets = numpy.zeros(len(encoded)+1, dtype=numpy.int64)
+        numpy.cumsum([len(e) for e in encoded], out=self.offsets[1:])
+        self.data = numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8)
+
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+
+    def __getitem__(self, index):
+        return self.get_bytes(index).decode('utf-8', 'surrogateescape')
+
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+    def get_bytes(self, index):
+        if index<0 or index>=len(self):
+            raise IndexError('Path index out of range')
+        return self.data[self.offsets[index]:self.offsets[index+1]].tobytes()
+
+
+    def nbytes(self):
+        return self.data.nbytes + self.offsets.nbytes
+
+
+class PackedPathIndex(object):
+    ''' Map paths to musly IDs via the CRC32 of each path - sorted, so that the IDs of a CRC are found by a
+        binary search, and then confirmed against the packed paths. '''
+    def __init__(self, paths):
+        self.paths = paths
+        crcs = numpy.fromiter((zlib.crc32(paths.get_bytes(i)) for i in range(len(paths))), dtype=numpy.uint32, count=len(paths))
+        order = numpy.argsort(crcs, kind='stable')
+        self.crcs = crcs[order]
+        self.ids = order.astype(numpy.int32)
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def get(self, path, default):
+        data = encode(path)
+        crc = zlib.crc32(data)
+        pos = int(numpy.searchsorted(self.crcs, crc))
+        while pos<len(self.crcs) and self.crcs[pos]==crc:
+            track_id = int(self.ids[pos])
+            if self.paths.get_bytes(track_id)==data:
+                return track_id
+            pos += 1
+        return default
+
+
+class PathIndex(object):
+    ''' Map DB paths (and any of the forms LMS sends) to musly IDs '''
+    def __init__(self, paths, root):
+        self.root = root
+        if isinstance(paths, PackedPaths):
+            self.ids = PackedPathIndex(paths)
+        else:
+            self.ids = {}
+            for i in range(len(paths)):
+                self.ids[paths[i]]=i
+        _LOGGER.debug('Path index contains %d tracks' % len(self.ids))
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def get(self, url):
+        ''' Return musly ID of track, or -1 if not found '''
+        return self.ids.get(decode(url, self.root), -1)
+
+
+    def resolve(self, urls):
+        ''' Return list of musly IDs for urls, -1 is used for tracks not found '''
+        ids = self.ids
+        root = self.root
+        return [ids.get(decode(url, root), -1) for url in urls]
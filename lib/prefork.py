@@ -0,0 +1,140 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import gc
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from werkzeug import serving
+
+_LOGGER = logging.getLogger(__name__)
+
+CHECK_INTERVAL     = 0.5 # How often master checks on workers
+MIN_WORKER_RUNTIME = 2   # If a worker exits before this many seconds, wait before restarting it
+STOP_TIMEOUT       = 30  # Max time a worker waits for active requests to finish when stopping
+
+
+class Master(object):
+    ''' Load state once, then fork workers to serve requests. Workers share the listening socket, and the
+        state loaded by the master (numpy arrays, and memory-mapped files, are shared copy-on-write). '''
+    def __init__(self, app, host, port, num_workers):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = num_workers
+        self.workers = {} # pid -> start time
+        self.stopping = False
+        self.reload_requested = False
+        family = serving.select_address_family(host, port)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(serving.get_sockaddr(host, port, family))
+        self.sock.listen(128)
+        self.sock.set_inheritable(True)
+
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        _LOGGER.info('Starting %d workers, listening on %s:%d' % (self.num_workers, self.host, self.port))
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap()
+            while len(self.workers)<self.num_workers and not self.stopping:
+                self.spawn()
+            time.sleep(CHECK_INTERVAL)
+        self.stop_workers(list(self.workers.keys()))
+        self.sock.close()
+
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+
+    def spawn(self):
+        # Move objects loaded so far out of the garbage collector's view, so that collections in workers do not
+        # write to (and so copy) the pages holding these
+        gc.freeze()
+        pid = os.fork()
+        if pid==0:
+            code = 0
+            try:
+                run_worker(self.app, self.sock, self.host, self.port)
+            except Exception as e:
+                _LOGGER.error('Worker failed - %s' % str(e))
+                code = 1
+            os._exit(code)
+        self.workers[pid] = time.time()
+        _LOGGER.debug('Started worker %d' % pid)
+
+
+    def reap(self):
+        while len(self.workers)>0:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid==0:
+                return
+            if pid in self.workers:
+                started = self.workers.pop(pid)
+                _LOGGER.error('Worker %d exited unexpectedly (status %d), restarting' % (pid, status))
+                if time.time()-started<MIN_WORKER_RUNTIME:
+                    time.sleep(MIN_WORKER_RUNTIME)
+
+
+    def reload(self):
+        ''' Load new generation, start workers for this, then stop the old workers '''
+        if not self.app.load_generation():
+            return
+        old = list(self.workers.keys())
+        self.workers = {}
+        for i in range(self.num_workers):
+            self.spawn()
+        self.stop_workers(old)
+
+
+    def stop_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
+def run_worker(app, sock, host, port):
+    app.master_pid = os.getppid()
+    server = serving.make_server(host, port, app, threaded=True, fd=sock.fileno())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, lambda signum, frame: app.reload())
+    # shutdown() blocks until serve_forever() returns, so cannot be called from the signal handler itself
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+
+    # Let active requests complete
+    stop_time = time.time()+STOP_TIMEOUT
+    while app.generation.leases>0 and time.time()<stop_time:
+        time.sleep(0.1)
+
+
+def serve(app, host, port, num_workers):
+    Master(app, host, port, num_workers).run()
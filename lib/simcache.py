@@ -0,0 +1,77 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging
+import threading
+from collections import OrderedDict
+from . import metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class SimilarityCache(object):
+    ''' LRU cache of the similarity rows of seed tracks, keyed on musly ID. Size is limited by
+        the memory used by the cached rows, and rows grow as more of them is sorted - so the
+        size of a row is re-checked each time it is used. '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, track_id):
+        with self.lock:
+            simtracks = self.entries.get(track_id)
+            if simtracks is None:
+                self.misses += 1
+                metrics.CACHE_REQUESTS.inc('miss')
+                return None
+            self.hits += 1
+            metrics.CACHE_REQUESTS.inc('hit')
+            self.entries.move_to_end(track_id)
+            self.update_size(track_id, simtracks)
+            return simtracks
+
+
+    def put(self, track_id, simtracks):
+        if self.max_bytes<=0 or simtracks is None:
+            return
+        with self.lock:
+            if track_id in self.entries:
+                self.total_bytes -= self.sizes[track_id]
+            self.entries[track_id] = simtracks
+            self.entries.move_to_end(track_id)
+            self.sizes[track_id] = 0
+            self.update_size(track_id, simtracks)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.total_bytes = 0
+
+
+    def update_size(self, track_id, simtracks):
+        ''' Update size of entry, and remove least recently used entries if now too large. Lock must be held. '''
+        size = simtracks.nbytes()
+        self.total_bytes += size - self.sizes[track_id]
+        self.sizes[track_id] = size
+        while self.total_bytes>self.max_bytes and len(self.entries)>0:
+            (oldest, _) = self.entries.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(oldest)
+            self.evictions += 1
+
+
+    def stats(self):
+        with self.lock:
+            return {'entries':len(self.entries), 'bytes':self.total_bytes, 'max_bytes':self.max_bytes, 'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions}
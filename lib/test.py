@@ -7,46 +7,59 @@
 
 import logging
 import math
+import numpy
 import os
 import sys
-from . import metadata_db, musly
+from . import features, jukebox, metadata_db, musly, timbre
 
 _LOGGER = logging.getLogger(__name__)
+ENGINE_TOLERANCE = 1e-4
+ENGINE_TEST_SEEDS = 20
+
+
+def test_engine(mus, mta):
+    ''' Check that the NumPy engine calculates the same similarities as libmusly '''
+    try:
+        engine = timbre.TimbreEngine(mus, mta.mtracks)
+    except ValueError as e:
+        _LOGGER.error('Failed to create NumPy similarity engine - %s' % str(e))
+        return False
+    step = max(1, len(engine)//ENGINE_TEST_SEEDS)
+    try:
+        diff = timbre.max_difference(engine, mus, mta.mtracks, mta.mtrackids, list(range(0, len(engine), step)))
+    except ValueError as e:
+        _LOGGER.error('Failed to compare NumPy similarities - %s' % str(e))
+        return False
+    if diff>ENGINE_TOLERANCE:
+        _LOGGER.error('NumPy similarities differ from Musly by %f' % diff)
+        return False
+    _LOGGER.info('NumPy similarities match Musly (max difference %g)' % diff)
+    return True
+
 
 def test_jukebox(mus, app_config, jukebox_path, repeat):
     _LOGGER.info('Testing musly')
 
     meta_db = metadata_db.MetadataDb(app_config)
-    (paths, tracks) = mus.get_alltracks_db(meta_db.get_cursor())
+    (paths, tracks) = features.load_tracks(mus, app_config, meta_db)
 
     while True:
-        ids = None
-
-        # If we can, load musly from jukebox...
-        if os.path.exists(jukebox_path):
-            ids = mus.get_jukebox_from_file(jukebox_path)
-
-        if ids==None or len(ids)!=len(tracks):
-            _LOGGER.info('Adding tracks from DB to musly')
-            ids = mus.add_tracks(tracks, app_config['styletracks'], app_config['styletracksmethod'], meta_db)
-            mus.write_jukebox(jukebox_path)
-
-        meta_db.close()
+        # Load musly from jukebox, adding any new tracks
+        ids = jukebox.update_jukebox(mus, app_config, meta_db, jukebox_path, paths, tracks)
         mta=musly.MuslyTracksAdded(paths, tracks, ids)
 
         simtracks = mus.get_similars( mta.mtracks, mta.mtrackids, 0 )
-        if len(simtracks)<2:
+        if simtracks is None or len(simtracks)<2:
             _LOGGER.error('Too few tracks returned from similarity query???')
         else:
-            simtracks = simtracks[:51]
+            (sim_ids, sim_vals) = simtracks.get(0, 51)
             sims=[]
-            nans=0
-            for i in range(1, len(simtracks)):
-                _LOGGER.debug('[%i] ID:%i Sim:%f' % (i, simtracks[i]['id'], simtracks[i]['sim']))
-                if math.isnan(simtracks[i]['sim']):
-                    nans += 1
-                elif simtracks[i]['sim'] not in sims:
-                    sims.append(simtracks[i]['sim'])
+            # Tracks with invalid similarities are sorted last, so check all tracks for these
+            nans=int(numpy.count_nonzero(numpy.isnan(simtracks.sims)))
+            for i in range(1, len(sim_ids)):
+                _LOGGER.debug('[%i] ID:%i Sim:%f' % (i, sim_ids[i], sim_vals[i]))
+                if not math.isnan(sim_vals[i]) and sim_vals[i] not in sims:
+                    sims.append(sim_vals[i])
             if nans>0:
                 if not repeat:
                     _LOGGER.error('Musly returned an invalid similarity? Suggest you remove %s (and perhaps alter styletracks in config?)' % jukebox_path)
@@ -56,7 +69,10 @@ def test_jukebox(mus, app_config, jukebox_path, repeat):
                     _LOGGER.error('All similarities the same? Suggest you remove %s (and perhaps alter styletracks in config?)' % jukebox_path)
                     sys.exit(-1)
             else:
-                _LOGGER.info('Musly returned %d different similarities for %d tracks' % (len(sims), len(simtracks)-1))
+                _LOGGER.info('Musly returned %d different similarities for %d tracks' % (len(sims), len(sim_ids)-1))
+                meta_db.close()
+                if not test_engine(mus, mta):
+                    sys.exit(-1)
                 return
         if repeat:
             _LOGGER.error('All similarities the same, or invalid similarity returned. Deleteing jukebox and re-trying')
@@ -0,0 +1,150 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import logging
+import math
+import numpy
+import time
+from . import metrics, musly
+
+_LOGGER = logging.getLogger(__name__)
+
+# Number of (seed, track) pairs whose mixed covariance matrices are calculated at once
+PAIRS_PER_CHUNK = 2048
+
+# Mutual proximity state of each track, as serialised after the jukebox header
+FACTS_DTYPE = numpy.dtype([('id', '<i4'), ('mu', '<f4'), ('std', '<f4')])
+
+
+def get_dimension(mtracksize):
+    ''' A timbre track is float32 mean[d], upper triangle of covariance[d*(d+1)/2], and log determinant of covariance '''
+    num_floats = mtracksize//4
+    dim = int((math.sqrt(1+8*num_floats)-3)/2)
+    if dim<1 or dim+(dim*(dim+1)//2)+1!=num_floats:
+        raise ValueError('Unexpected track size %d' % mtracksize)
+    return dim
+
+
+def normal_sf(x):
+    ''' 1-normcdf(x), i.e. 0.5*erfc(x/sqrt(2)) - erfc from Numerical Recipes, fractional error < 1.2e-7 '''
+    z = numpy.abs(x)/math.sqrt(2.0)
+    t = 1.0/(1.0+0.5*z)
+    poly = -1.26551223+t*(1.00002368+t*(0.37409196+t*(0.09678418+t*(-0.18628806+t*(0.27886807+t*(-1.13520398+t*(1.48851587+t*(-0.82215223+t*0.17087277))))))))
+    erfc = t*numpy.exp(-z*z+poly)
+    return 0.5*numpy.where(x>=0, erfc, 2.0-erfc)
+
+
+def get_models(mus, mtracks):
+    ''' View (without copying) the mean, covariance upper triangle, and log determinant of each track's model '''
+    dim = get_dimension(mus.mtracksize)
+    num_tracks = len(mtracks)
+    num_floats = mus.mtracksize//4
+    data = numpy.asarray(mtracks.buf).reshape(-1)[mtracks.offset:mtracks.offset+(num_tracks*mtracks.stride)]
+    vals = data.reshape(num_tracks, mtracks.stride)[:, :num_floats*4].view(numpy.float32)
+    return (vals[:, :dim], vals[:, dim:num_floats-1], vals[:, num_floats-1])
+
+
+class TimbreEngine(object):
+    ''' Calculate similarities with NumPy, rather than libmusly. Track models are read, without copying,
+        from the feature buffer and the mutual proximity statistics are read from the jukebox. Distances
+        are Jensen-Shannon divergences of the Gaussian models, which are then normalised by mutual
+        proximity - as libmusly's 'timbre' method. Track IDs must be the same as their index. '''
+    def __init__(self, mus, mtracks, mj=None):
+        self.dim = get_dimension(mus.mtracksize)
+        num_tracks = len(mtracks)
+        (self.means, self.covars, self.logdets) = get_models(mus, mtracks)
+        (self.upper, self.lower) = numpy.triu_indices(self.dim)
+        (self.mu, self.std) = self.load_facts(mus, mj, num_tracks)
+        _LOGGER.debug('NumPy similarity engine, %d tracks of dimension %d' % (num_tracks, self.dim))
+
+
+    def load_facts(self, mus, mj, num_tracks):
+        ''' Read mean and std-dev of each track's distances to the music style tracks from the jukebox '''
+        data = mus.get_jukebox_bin(mj)
+        if data is None:
+            raise ValueError('Failed to read jukebox')
+        (header_size, buf) = data
+        if len(buf)!=header_size+(num_tracks*FACTS_DTYPE.itemsize):
+            raise ValueError('Jukebox does not match tracks')
+        facts = numpy.frombuffer(buf, dtype=FACTS_DTYPE, offset=header_size)
+        if not numpy.array_equal(numpy.sort(facts['id']), numpy.arange(num_tracks)):
+            raise ValueError('Jukebox track IDs are not the same as their index')
+        mu = numpy.empty(num_tracks)
+        std = numpy.empty(num_tracks)
+        mu[facts['id']] = facts['mu']
+        std[facts['id']] = facts['std']
+        return (mu, std)
+
+
+    def __len__(self):
+        return len(self.mu)
+
+
+    def calc_distances(self, seeds, start, end):
+        ''' Jensen-Shannon distance of each seed to tracks start..end, returned as [seeds, tracks] '''
+        seed_means = self.means[seeds].astype(numpy.float64)[:, None, :]
+        seed_covars = self.covars[seeds].astype(numpy.float64)[:, None, :]
+        means = self.means[start:end].astype(numpy.float64)[None, :, :]
+        covars = self.covars[start:end].astype(numpy.float64)[None, :, :]
+        # Covariance of the mixture of the 2 Gaussians: 0.5*(Ca+Cb) + 0.25*(ma-mb)(ma-mb)'
+        diff = seed_means-means
+        mixed = 0.5*(seed_covars+covars) + 0.25*(diff[..., self.upper]*diff[..., self.lower])
+        full = numpy.empty(mixed.shape[:2]+(self.dim, self.dim))
+        full[..., self.upper, self.lower] = mixed
+        full[..., self.lower, self.upper] = mixed
+        try:
+            # Cholesky is quicker than LU, but fails for the whole chunk if any matrix is not positive definite
+            chol = numpy.linalg.cholesky(full)
+            logdet = 2.0*numpy.log(numpy.diagonal(chol, axis1=-2, axis2=-1)).sum(axis=-1)
+            sign = numpy.ones(logdet.shape)
+        except numpy.linalg.LinAlgError:
+            (sign, logdet) = numpy.linalg.slogdet(full)
+        logdets = 0.5*(self.logdets[seeds].astype(numpy.float64)[:, None] + self.logdets[start:end][None, :])
+        with numpy.errstate(invalid='ignore'):
+            dists = numpy.sqrt(numpy.maximum(0.5*(logdet-logdets), 0.0))
+        dists[sign<=0] = numpy.nan
+        return dists
+
+
+    def calc_similarities(self, seeds):
+        ''' Similarity of each seed to all tracks, as a float32 array of [seeds, tracks] '''
+        seeds = numpy.asarray(seeds, dtype=numpy.intp)
+        num_tracks = len(self.mu)
+        sims = numpy.empty((len(seeds), num_tracks), dtype=numpy.float32)
+        chunk = max(1, PAIRS_PER_CHUNK//len(seeds))
+        seed_mu = self.mu[seeds][:, None]
+        seed_std = self.std[seeds][:, None]
+        for start in range(0, num_tracks, chunk):
+            end = min(start+chunk, num_tracks)
+            dists = self.calc_distances(seeds, start, end)
+            # Mutual proximity - probability that neither track is closer to another track
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                sims[:, start:end] = 1.0-(normal_sf((dists-seed_mu)/seed_std)*normal_sf((dists-self.mu[None, start:end])/self.std[None, start:end]))
+        sims[numpy.arange(len(seeds)), seeds] = 0.0
+        return sims
+
+
+    def get_similars(self, seeds):
+        ''' Get SimilarTracks for each seed, in the same order as seeds '''
+        start = time.monotonic()
+        sims = self.calc_similarities(seeds)
+        metrics.SIMILARITY_SECONDS.observe((time.monotonic()-start)/len(seeds))
+        return [musly.SimilarTracks(sims[i]) for i in range(len(seeds))]
+
+
+def max_difference(engine, mus, mtracks, mtrackids, seeds, mj=None):
+    ''' Largest difference between the similarities calculated by engine, and by libmusly '''
+    worst = 0.0
+    for seed, simtracks in zip(seeds, engine.get_similars(seeds)):
+        expected = mus.get_similars(mtracks, mtrackids, seed, mj)
+        if expected is None:
+            raise ValueError('libmusly failed to calculate similarities')
+        # Both should agree on which tracks do not have a valid similarity
+        if not numpy.array_equal(numpy.isnan(simtracks.sims), numpy.isnan(expected.sims)):
+            return math.inf
+        worst = max(worst, float(numpy.nanmax(numpy.abs(simtracks.sims-expected.sims), initial=0.0)))
+    return worst
@@ -0,0 +1,75 @@
+#
+# Analyse files with Musly, and provide an API to retrieve similar tracks
+#
+# Copyright (c) 2020-2021 Craig Drummond <craig.p.drummond@gmail.com>
+# GPLv3 license.
+#
+
+import time
+
+
+class NullTrace(object):
+    ''' Used when a request has not asked for an explanation, so that tracing costs nothing. Callers should
+        check 'enabled' before preparing anything that is only needed for a trace. '''
+    enabled = False
+
+    def stage(self, name):
+        pass
+
+
+class Trace(object):
+    ''' Record of how a request was handled - time taken by each stage, and why each candidate track was
+        accepted, filtered (only used if too few tracks are accepted), or discarded. '''
+    enabled = True
+
+    def __init__(self):
+        self.timings = []
+        self.seeds = {}
+        self.last = time.perf_counter()
+
+
+    def stage(self, name):
+        ''' Mark the end of a stage '''
+        now = time.perf_counter()
+        self.timings.append((name, now-self.last))
+        self.last = now
+
+
+    def get_seed(self, seed_id):
+        if seed_id not in self.seeds:
+            self.seeds[seed_id] = {'excluded':0, 'candidates':[]}
+        return self.seeds[seed_id]
+
+
+    def excluded(self, seed_id, count):
+        ''' Tracks removed before filtering - seeds, previous tracks, and those outside of the similarity range '''
+        self.get_seed(seed_id)['excluded'] += int(count)
+
+
+    def candidate(self, seed_id, track_id, sim, result, reason=None):
+        self.get_seed(seed_id)['candidates'].append((track_id, sim, result, reason))
+
+
+    def discarded(self, seed_id, ids, sims, discards):
+        ''' Record discarded tracks, with the first reason from the list of (reason, mask) tuples '''
+        for pos in range(len(ids)):
+            for (reason, mask) in discards:
+                if mask[pos]:
+                    self.candidate(seed_id, int(ids[pos]), float(sims[pos]), 'discarded', reason)
+                    break
+
+
+    def to_dict(self, paths):
+        seeds = []
+        for seed_id, seed in self.seeds.items():
+            candidates = []
+            for (track_id, sim, result, reason) in sorted(seed['candidates'], key=lambda c: c[1]):
+                entry = {'file':paths[track_id], 'sim':round(sim, 6), 'result':result}
+                if reason is not None:
+                    entry['reason'] = reason
+                candidates.append(entry)
+            seeds.append({'seed':paths[seed_id], 'excluded':seed['excluded'], 'candidates':candidates})
+        return {'timings':{name: round(secs*1000.0, 3) for (name, secs) in self.timings}, 'seeds':seeds}
+
+
+NULL_TRACE = NullTrace()
@@ -10,9 +10,10 @@
 import argparse
 import logging
 import os
-from lib import analysis, app, config, metadata_db, musly, test, version
+from lib import analysis, app, clusters, config, metadata_db, musly, neighbours, test, version
 
 JUKEBOX_FILE = 'musly.jukebox'
+NEIGHBOURS_FILE = 'musly.neighbours'
 _LOGGER = logging.getLogger(__name__)
         
 if __name__=='__main__':
@@ -22,6 +23,10 @@ if __name__=='__main__':
     parser.add_argument('-a', '--analyse', metavar='PATH', type=str, help="Analyse file/folder (use 'm' for configured musly folder)", default='')
     parser.add_argument('-m', '--meta-only', action='store_true', default=False, help='Update metadata database only (used in conjuction with --analyse)')
     parser.add_argument('-k', '--keep-old', action='store_true', default=False, help='Do not remove non-existant tracks from DB (used in conjuction with --analyse)')
+    parser.add_argument('-s', '--restyle', action='store_true', default=False, help='Choose new style tracks, and re-create jukebox (may be used in conjuction with --analyse)')
+    parser.add_argument('-n', '--build-neighbours', metavar='N', type=int, help='Create file containing the N most similar tracks to each track, used to speed up the API', default=0)
+    parser.add_argument('-p', '--cluster-recall', metavar='K', type=int, help='Check recall of the K most similar tracks found via the cluster index, against an exact search', default=0)
+    parser.add_argument('-w', '--workers', metavar='N', type=int, help='Serve API from N pre-forked worker processes, sharing state loaded once (default: single process)', default=0)
     parser.add_argument('-t', '--test', action='store_true', default=False, help='Test musly')
     parser.add_argument('-r', '--repeat', action='store_true', default=False, help='Repeat test until OK (used in conjuction with --test)')
     args = parser.parse_args()
@@ -34,11 +39,18 @@ if __name__=='__main__':
     _LOGGER.debug('Init Musly')
     mus = musly.Musly(lib)
     jukebox_file = os.path.join(cfg['paths']['db'], JUKEBOX_FILE)
+    neighbours_file = os.path.join(cfg['paths']['db'], NEIGHBOURS_FILE)
     if args.analyse:
         path = cfg['paths']['musly'] if args.analyse =='m' else args.analyse
-        analysis.analyse_files(mus, cfg, path, not args.keep_old, args.meta_only, jukebox_file)
+        analysis.analyse_files(mus, cfg, path, not args.keep_old, args.meta_only, args.restyle, jukebox_file, neighbours_file)
+    elif args.restyle:
+        analysis.restyle_jukebox(mus, cfg, jukebox_file, neighbours_file)
+    elif args.build_neighbours>0:
+        neighbours.build_neighbours(mus, cfg, jukebox_file, neighbours_file, args.build_neighbours)
+    elif args.cluster_recall>0:
+        clusters.check_recall(mus, cfg, jukebox_file, args.cluster_recall)
     elif args.test:
         test.test_jukebox(mus, cfg, jukebox_file, args.repeat)
     else:
-        app.start_app(args, mus, cfg, jukebox_file)
+        app.start_app(args, mus, cfg, jukebox_file, neighbours_file)
 